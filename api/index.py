@@ -1,14 +1,51 @@
 import os
 import json
-from cachetools import TTLCache, cached
-from flask import Flask, jsonify, Response, stream_with_context, request
+from cachetools import LRUCache, TTLCache
+from flask import Flask, Response, abort, stream_with_context, request, redirect, send_file, send_from_directory
+from werkzeug.utils import safe_join
 from ytmusicapi import YTMusic
 import yt_dlp
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows: không có khóa file giữa các tiến trình
+    fcntl = None
+try:
+    import orjson # nhanh hơn nhiều so với json của thư viện chuẩn
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image # Pillow, để tạo ảnh thu nhỏ; không có thì luôn trả ảnh gốc
+except ImportError:
+    Image = None
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+import gzip
 import hashlib
+import heapq
+import io
+import queue
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import threading
+import unicodedata
+from bisect import bisect_left
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 # Thống nhất trong các object "songs" các thuộc tính (properties) là:
 # "artist": "Alex Warren",
@@ -16,16 +53,22 @@ import hashlib
 # "thumbnail_url": "https://i.ytimg.com/vi/u2ah9tWTkmk/sddefault.jpg?sqp=-oaymwEWCJADEOEBIAQqCghqEJQEGHgg6AJIWg&rs=AMzJL3me2eNS4hDgHGyO2U9dQYnLc4wZjQ",
 # "title": "Ordinary",
 # "video_id": "u2ah9tWTkmk"
-stream_cache = TTLCache(maxsize=1024, ttl=3600)
 IMAGE_CACHE_DIR = os.path.join('static', 'images')
 os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+METADATA_DB_FILENAME = 'metadata.db'
+# Các file / thư mục cache JSON cũ, chỉ còn dùng để chuyển dữ liệu vào metadata.db lúc khởi động
 CACHE_FILENAME_TRENDING = "trending_cache.json"
 CACHE_FILENAME_ARTISTS = 'popular_artists_cache.json'
 ARTIST_DETAIL_CACHE_FOLDER = 'artist_details_cache'
 CACHE_FILENAME_MADE_FOR_YOU = 'made_for_you_cache.json'
 PLAYLIST_DETAIL_CACHE_FOLDER = 'playlist_details_cache'
+# Key trong metadata store
+POPULAR_ARTISTS_KEY = 'collection:popular_artists'
+MADE_FOR_YOU_KEY = 'collection:made_for_you'
 CACHE_DURATION_HOURS = 1000 # 15 days
+METADATA_TTL = CACHE_DURATION_HOURS * 3600 # TTL mặc định (giây) của mỗi dòng trong metadata store
 ARTIST_IMAGE_FOLDER = 'static/artists'
+THUMBNAIL_DERIVATIVE_FOLDER = 'image_derivatives'
 DOWNLOAD_FOLDER = 'temp_downloads'
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
@@ -39,15 +82,985 @@ MADE_FOR_YOU_PLAYLISTS_IDS = [
     'PL15B1E77BB5708555'  # Most View Songs of All Time
 ]
 
+# Các nhóm tìm kiếm của /api/search: (filter của yt.search, limit), theo thứ tự hiển thị
+SEARCH_GROUPS = [
+    ('artists', 3),
+    ('songs', 5),
+    ('playlists', 3),
+]
+SEARCH_LOCAL_ONLY = 'local' # ?source=local: chỉ tìm trong chỉ mục cục bộ
+# Gợi ý tìm kiếm (/api/suggest)
+SUGGEST_TOP_K = 10 # số gợi ý tối đa mỗi request
+SUGGEST_MAX_PHRASES = 20000 # số cụm từ giữ trong bộ nhớ mỗi worker, vượt quá thì bỏ các cụm trọng số thấp nhất
+SUGGEST_PRECOMPUTED_PREFIX = 2 # tiền tố ngắn tới độ dài này có top-k tính sẵn (khớp quá nhiều cụm để duyệt)
+SUGGEST_SYNC_INTERVAL = 60 # giây giữa các lần nạp thêm dữ liệu mới từ metadata.db
+SUGGEST_TYPE_WEIGHTS = {'artist': 3, 'playlist': 2, 'song': 1}
+SUGGEST_QUERY_WEIGHT = 2 # điểm cộng mỗi lần một truy vấn tìm kiếm thành công
+SEARCH_CALL_TIMEOUT = 8 # giây, deadline cho mỗi lần gọi yt.search
+UPSTREAM_MAX_WORKERS = 16
+BACKGROUND_MAX_WORKERS = 4
+SEARCH_CACHE_MAXSIZE = 2048 # số truy vấn tối đa giữ trong bộ nhớ
+SEARCH_CACHE_TTL = 600 # giây, kết quả còn "mới"
+SEARCH_CACHE_STALE_TTL = 3600 # giây, sau TTL vẫn trả kết quả cũ và làm mới ở background
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_QUEUE_MAX = 500 # số ảnh tối đa đang chờ tải, vượt quá thì bỏ qua (client dùng URL gốc)
+THUMBNAIL_MAX_RETRIES = 2
+THUMBNAIL_RETRY_BACKOFF = 0.5 # giây, nhân đôi sau mỗi lần thử lại
+IMAGE_STORE_MAX_BYTES = 1024 ** 3 # dung lượng đĩa tối đa cho ảnh gốc đã tải (LRU)
+IMAGE_STORE_EVICT_INTERVAL = 300 # giây, khoảng cách tối thiểu giữa hai lần dọn
+IMAGE_STORE_TOUCH_FLUSH_INTERVAL = 30 # giây, lần truy cập được gom trong bộ nhớ rồi ghi vào metadata.db
+IMAGE_STORE_PART_MAX_AGE = 600 # giây, file .part cũ hơn thế lúc khởi động là của lần tải bị ngắt
+IMAGE_STORE_SOURCE_MAX_AGE = 30 * 86400 # giây, dòng chỉ còn URL gốc (file đã bị dọn) không ai xin lâu hơn thế thì bỏ
+THUMBNAIL_WIDTHS = (64, 256, 544) # các cỡ ảnh thu nhỏ, ?w= được làm tròn lên cỡ gần nhất
+THUMBNAIL_WEBP_QUALITY = 80
+THUMBNAIL_JPEG_QUALITY = 85
+THUMBNAIL_DERIVATIVE_MAX_BYTES = 256 * 1024 ** 2 # dung lượng đĩa tối đa cho ảnh thu nhỏ (LRU)
+THUMBNAIL_DERIVATIVE_EVICT_INTERVAL = 60 # giây, khoảng cách tối thiểu giữa hai lần dọn
+THUMBNAIL_SOURCE_TIMEOUT = 5 # giây, tải ảnh gốc cho /image-proxy?w=
+THUMBNAIL_SOURCE_MAX_BYTES = 8 * 1024 ** 2 # ảnh gốc lớn hơn thì không thu nhỏ
+THUMBNAIL_SOURCE_HOSTS = ('ytimg.com', 'googleusercontent.com', 'ggpht.com') # chỉ thu nhỏ ảnh từ các host này
+THUMBNAIL_MAX_PIXELS = 4096 * 4096 # chặn ảnh "bom giải nén" trước khi giải mã
+IMAGE_CLIENT_MAX_AGE = 7 * 86400 # giây, ảnh thu nhỏ gắn với nội dung ảnh gốc nên client cache lâu được
+HTTP_POOL_CONNECTIONS = 16 # số host được giữ pool kết nối (i.ytimg.com, *.googlevideo.com, ...)
+HTTP_POOL_MAXSIZE = 32 # số kết nối keep-alive tối đa cho mỗi host
+HTTP_CONNECT_TIMEOUT = 3.05 # giây
+HTTP_READ_TIMEOUT = 15 # giây
+HTTP_CONNECT_RETRIES = 2 # chỉ thử lại khi lỗi kết nối, không thử lại khi đọc dở
+HTTP_RETRY_BACKOFF = 0.3 # giây
+CACHE_LOCK_FOLDER = 'cache_locks'
+CACHE_LOCK_STRIPES = 64 # số khóa trong process dùng chung cho việc tạo ảnh thu nhỏ
+CACHE_LOCK_TIMEOUT = 30 # giây chờ worker khác ghi cache trước khi tự lấy dữ liệu
+DB_POOL_SIZE = 8 # số kết nối SQLite rảnh giữ lại mỗi process
+JSON_MEMORY_CACHE_MAXSIZE = 512 # số file cache JSON giữ sẵn dạng bytes trong bộ nhớ
+JSON_MEMORY_CACHE_STAT_INTERVAL = 1.0 # giây, khoảng cách tối thiểu giữa hai lần kiểm tra version trong metadata.db
+CLIENT_CACHE_MAX_AGE = 3600 # giây, Cache-Control max-age cho các endpoint JSON có cache
+CLIENT_CACHE_STALE_WHILE_REVALIDATE = 86400 # giây, client được dùng bản cũ trong lúc kiểm tra lại
+JSON_COMPRESS_MIN_BYTES = 1024 # body cache nhỏ hơn thì gửi nguyên, nén không đáng
+JSON_GZIP_LEVEL = 6
+JSON_BROTLI_QUALITY = 5 # đủ nhanh để nén lúc chạy, vẫn nhỏ hơn gzip
+AUDIO_CACHE_FOLDER = 'audio_cache'
+AUDIO_CACHE_MAX_BYTES = 2 * 1024 ** 3 # dung lượng đĩa tối đa cho audio đã cache (LRU)
+AUDIO_CACHE_FLUSH_BYTES = 1024 ** 2 # ghi lại metadata các khoảng đã cache sau mỗi 1 MB
+AUDIO_CACHE_EVICT_INTERVAL = 60 # giây, khoảng cách tối thiểu giữa hai lần dọn cache
+STREAM_CHUNK_MIN_SIZE = 64 * 1024 # chunk đầu tiên nhỏ để byte đầu tới client sớm
+STREAM_CHUNK_MAX_SIZE = 1024 ** 2 # chunk tăng gấp đôi mỗi lần đọc đầy buffer, tới tối đa 1 MB
+AUDIO_CACHE_SENDFILE = True # dùng wsgi.file_wrapper (sendfile trên gunicorn) khi khoảng yêu cầu đã cache đủ
+STREAM_STATS_HISTORY = 100 # số stream gần nhất giữ thống kê throughput
+STREAM_CACHE_MAXSIZE = 1024
+STREAM_URL_EXPIRY_MARGIN = 300 # giây, bỏ URL googlevideo trước thời điểm expire= của nó
+STREAM_URL_DEFAULT_TTL = 3600 # giây, khi URL không có tham số expire
+STREAM_URL_NEGATIVE_TTL = 60 # giây, chỉ nhớ lỗi resolve trong thời gian ngắn
+STREAM_URL_REFRESH_AHEAD = 900 # giây trước khi hết hạn thì làm mới nền các URL đang được nghe nhiều
+STREAM_URL_HOT_HITS = 2 # số lần dùng tối thiểu để một URL được coi là "nóng"
+YTDLP_POOL_SIZE = 4 # số instance YoutubeDL dùng lại, cũng là số resolve chạy đồng thời tối đa
+YTDLP_CHECKOUT_TIMEOUT = 10 # giây chờ một instance rảnh trước khi báo quá tải
+YTDLP_CACHE_DIR = 'ytdlp_cache' # cache chữ ký player trên đĩa, dùng chung giữa các worker
+STREAM_PREFETCH_COUNT = 5 # số bài đầu của playlist / trending được resolve trước khi client mở
+STREAM_PREFETCH_WORKERS = 2
+STREAM_PREFETCH_QUEUE_MAX = 200
+STREAM_PREFETCH_BATCH_MAX = 100 # số video_id tối đa trong một request /api/resolve
+STREAM_PREFETCH_RATE = 1.0 # số resolve nền mỗi giây (token bucket)
+STREAM_PREFETCH_BURST = 5
+STREAM_PREFETCH_RESERVED_INSTANCES = 2 # luôn chừa lại ít nhất chừng này instance YoutubeDL cho request tương tác
+STREAM_PREFETCH_MAX_DEFER = 30 # giây chờ pool rảnh trước khi bỏ qua một resolve nền
+SONG_DETAILS_CACHE_MAXSIZE = 4096
+SONG_DETAILS_CACHE_TTL = 6 * 3600 # giây
+SONG_DETAILS_CACHE_STALE_TTL = 24 * 3600 # giây, sau TTL vẫn trả bản cũ và làm mới ở background
+SONG_BATCH_MAX_IDS = 50 # số video_id tối đa trong một request /api/songs
+SONG_BATCH_TIMEOUT = 15 # giây, bài nào chưa lấy xong sau thời gian này sẽ trả lỗi timeout
+
+# Danh sách nghệ sĩ nổi bật
+POPULAR_ARTISTS_LIMIT = 10
+POPULAR_ARTISTS_DEADLINE = 8 # giây, request trả về với những nghệ sĩ đã lấy xong trong thời gian này
+POPULAR_ARTISTS_BACKGROUND_TIMEOUT = 60 # giây chờ thêm ở background cho các nghệ sĩ còn lại
+
+# Phân trang /api/playlist/<id>
+PLAYLIST_PAGE_SIZE = 30 # số bài mặc định của một trang, cũng là số bài lấy lần đầu từ API
+PLAYLIST_MAX_PAGE_SIZE = 100
+PLAYLIST_MAX_TRACKS = 5000 # giới hạn số bài giữ trong cache của một playlist
+
+# Made for You
+MADE_FOR_YOU_FETCH_TIMEOUT = 20 # giây chờ tối đa cho cả nhóm playlist
+
+# Lịch làm mới cache ở background: dataset -> (interval, refresh_ahead, jitter), tính bằng giây.
+# Dataset được làm mới khi tuổi cache >= interval - refresh_ahead - random(0, jitter).
+REFRESH_SCHEDULE = {
+    'trending': (3600, 600, 300),
+    'popular_artists': (24 * 3600, 3600, 1800),
+    'made_for_you': (6 * 3600, 1800, 900),
+    'playlists': (12 * 3600, 1800, 900)
+}
+REFRESH_SCHEDULER_TICK = 30 # giây giữa các lần kiểm tra lịch
+REFRESH_MAX_CONCURRENT = 1 # số dataset làm mới cùng lúc, để phần lớn upstream_executor dành cho người dùng
+REFRESH_RETRY_BASE = 60 # giây chờ trước khi thử lại sau lỗi, nhân đôi mỗi lần lỗi liên tiếp
+REFRESH_RETRY_MAX = 1800
+REFRESH_PLAYLIST_BATCH = 10 # số playlist trong playlist_details_cache/ được làm mới mỗi lượt
+REFRESH_STATUS_FILENAME = 'refresh_status.json'
+
 yt = YTMusic('headers_auth.json')
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 logging.basicConfig(level=logging.INFO)
 
-# Store trending songs data in memory (since we can't use localStorage)
-trending_songs_cache = []
+# Pool dùng chung cho các lời gọi upstream "lá" (yt.search, yt.get_playlist, ...).
+# Task chạy trong pool này không được submit rồi chờ task khác của chính pool (tránh deadlock).
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix='upstream')
+# Pool cho các tác vụ nền có thể chờ upstream_executor (làm mới cache, ...)
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS, thread_name_prefix='background')
+
+
+# HTTP client dùng chung cho mọi lời gọi ra ngoài (ảnh, stream audio).
+# Giữ kết nối keep-alive theo từng host để không phải bắt tay TCP+TLS cho mỗi request.
+def _create_http_session():
+    retry = Retry(
+        total=None,
+        connect=HTTP_CONNECT_RETRIES,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session, adapter
+
+http_session, http_adapter = _create_http_session()
+
+def http_get(url, **kwargs):
+    """requests.get qua session dùng chung, có timeout mặc định."""
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return http_session.get(url, **kwargs)
+
+def http_pool_stats():
+    """Số request đã gửi, số kết nối mới và số lần dùng lại kết nối trong pool, theo host."""
+    pools = http_adapter.poolmanager.pools
+    hosts = {}
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host_stats = hosts.setdefault(pool.host, {'requests': 0, 'new_connections': 0})
+        host_stats['requests'] += pool.num_requests
+        host_stats['new_connections'] += pool.num_connections
+    for host_stats in hosts.values():
+        host_stats['pool_hits'] = max(host_stats['requests'] - host_stats['new_connections'], 0)
+    return {
+        'requests': sum(h['requests'] for h in hosts.values()),
+        'new_connections': sum(h['new_connections'] for h in hosts.values()),
+        'pool_hits': sum(h['pool_hits'] for h in hosts.values()),
+        'hosts': hosts
+    }
+
+def _iter_response_chunks(response):
+    """
+    Đọc body upstream bằng readinto vào một buffer dùng lại suốt stream.
+    Kích thước chunk bắt đầu từ STREAM_CHUNK_MIN_SIZE và tăng gấp đôi mỗi lần đọc đầy,
+    tới STREAM_CHUNK_MAX_SIZE. Yield memoryview trỏ vào buffer, chỉ hợp lệ tới lần lặp kế tiếp.
+    """
+    response.raw.decode_content = True
+    view = memoryview(bytearray(STREAM_CHUNK_MAX_SIZE))
+    chunk_size = STREAM_CHUNK_MIN_SIZE
+    while True:
+        read_bytes = response.raw.readinto(view[:chunk_size])
+        if not read_bytes:
+            break
+        yield view[:read_bytes]
+        if read_bytes == chunk_size and chunk_size < STREAM_CHUNK_MAX_SIZE:
+            chunk_size = min(chunk_size * 2, STREAM_CHUNK_MAX_SIZE)
+
+def _relay_response(response):
+    """Chuyển tiếp body của response upstream và luôn đóng nó để trả kết nối về pool."""
+    try:
+        for chunk in _iter_response_chunks(response):
+            # WSGI server cần bytes, và buffer sẽ bị ghi đè ở lần đọc sau
+            yield chunk.tobytes()
+    finally:
+        response.close()
+
+
+class StreamStats:
+    """Thống kê throughput cho từng stream (audio, ảnh) đi qua proxy."""
+
+    def __init__(self, history):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=history)
+        self._counters = {'active': 0, 'completed': 0, 'bytes': 0, 'sendfile': 0}
+
+    def track(self, chunks, name, source):
+        """Bọc generator body của response để đếm byte và thời gian truyền."""
+        started_at = time.monotonic()
+        sent_bytes = 0
+        with self._lock:
+            self._counters['active'] += 1
+        try:
+            for chunk in chunks:
+                sent_bytes += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            elapsed = max(time.monotonic() - started_at, 1e-6)
+            with self._lock:
+                self._counters['active'] -= 1
+                self._counters['completed'] += 1
+                self._counters['bytes'] += sent_bytes
+                self._recent.append({
+                    'name': name,
+                    'source': source,
+                    'bytes': sent_bytes,
+                    'seconds': round(elapsed, 3),
+                    'mbps': round(sent_bytes * 8 / elapsed / 1e6, 2)
+                })
+
+    def count_sendfile(self, sent_bytes):
+        with self._lock:
+            self._counters['sendfile'] += 1
+            self._counters['bytes'] += sent_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, recent=list(self._recent))
+
+stream_stats = StreamStats(STREAM_STATS_HISTORY)
+
+
+class StaleWhileRevalidateCache:
+    """
+    Cache LRU + TTL trong bộ nhớ.
+    - Entry còn mới: trả ngay.
+    - Entry đã cũ nhưng chưa quá stale_ttl: vẫn trả giá trị cũ và làm mới ở background.
+    - Nhiều lần miss đồng thời cho cùng một key chỉ gọi loader một lần.
+    """
+
+    def __init__(self, maxsize, ttl, stale_ttl, is_cacheable=None):
+        self._entries = LRUCache(maxsize=maxsize)
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._is_cacheable = is_cacheable
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> Future của lần load đang chạy
+
+    def get(self, key, loader):
+        """Trả giá trị của key, gọi loader() nếu chưa có trong cache."""
+        with self._lock:
+            hit, value = self._lookup(key, loader)
+            if hit:
+                return value
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._inflight[key] = Future()
+        if is_leader:
+            self._load(key, loader, future)
+        return future.result()
+
+    def get_if_present(self, key, loader):
+        """Trả giá trị đang có trong cache (kể cả đã cũ) hoặc None, không chờ loader."""
+        with self._lock:
+            return self._lookup(key, loader)[1]
+
+    def put(self, key, value):
+        if self._is_cacheable and not self._is_cacheable(value):
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+    def _lookup(self, key, loader):
+        # Gọi khi đang giữ self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        stored_at, value = entry
+        age = time.monotonic() - stored_at
+        if age < self._ttl:
+            return True, value
+        if age < self._ttl + self._stale_ttl:
+            if key not in self._inflight:
+                future = self._inflight[key] = Future()
+                background_executor.submit(self._load, key, loader, future)
+            return True, value
+        del self._entries[key]
+        return False, None
+
+    def _load(self, key, loader, future):
+        try:
+            value = loader()
+        except BaseException as e:
+            print(f"Lỗi khi tải dữ liệu cho cache key '{key}': {e}")
+            future.set_exception(e)
+        else:
+            self.put(key, value)
+            future.set_result(value)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+
+# Mô hình dữ liệu gọn trong bộ nhớ: chỉ chuyển thành dict / JSON ở biên (response, cache đã serialize)
+_model_lock = threading.Lock()
+# video_id -> Song còn được giữ ở đâu đó (cache, response đang dựng); tự mất khi không còn ai giữ
+_song_registry = weakref.WeakValueDictionary()
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Song:
+    """
+    Một bài hát. Song.get trả về cùng một object cho các bản ghi giống hệt nhau của một video_id,
+    nên một bài nằm trong nhiều playlist / kết quả tìm kiếm chỉ tốn bộ nhớ một lần.
+    Object dùng chung nên coi như bất biến. Tên nghệ sĩ, thời lượng và URL ảnh được intern
+    vì lặp lại rất nhiều.
+    """
+    __slots__ = ('video_id', 'title', 'artist', 'duration', 'thumbnail_url', '__weakref__')
+    KIND = 'song'
+
+    def __init__(self, video_id, title, artist, duration, thumbnail_url):
+        self.video_id = video_id
+        self.title = title
+        self.artist = _intern(artist)
+        self.duration = _intern(duration)
+        self.thumbnail_url = _intern(thumbnail_url)
+
+    @classmethod
+    def get(cls, video_id, title, artist, duration, thumbnail_url):
+        """Song dùng chung nếu đã có bản ghi giống hệt cho video_id, ngược lại tạo mới và ghi nhớ nó."""
+        if not video_id:
+            return cls(video_id, title, artist, duration, thumbnail_url)
+        with _model_lock:
+            song = _song_registry.get(video_id)
+            if song is None or (song.title, song.artist, song.duration, song.thumbnail_url) != (title, artist, duration, thumbnail_url):
+                # Nguồn khác nhau có thể định dạng khác nhau (thời lượng, ảnh); bản mới nhất được dùng chung từ đây
+                song = _song_registry[video_id] = cls(video_id, title, artist, duration, thumbnail_url)
+        return song
+
+    def to_json(self):
+        return {
+            'title': self.title,
+            'artist': self.artist,
+            'duration': self.duration,
+            'video_id': self.video_id,
+            'thumbnail_url': self.thumbnail_url
+        }
+
+
+class Artist:
+    """Nghệ sĩ trong danh sách / kết quả tìm kiếm."""
+    __slots__ = ('channel_id', 'name', 'thumbnail_url')
+    KIND = 'artist'
+
+    def __init__(self, channel_id, name, thumbnail_url):
+        self.channel_id = channel_id
+        self.name = _intern(name)
+        self.thumbnail_url = _intern(thumbnail_url)
+
+    def to_json(self):
+        return {'artistName': self.name, 'channelId': self.channel_id, 'thumbnailUrl': self.thumbnail_url}
+
+
+class Playlist:
+    """Playlist trong kết quả tìm kiếm."""
+    __slots__ = ('playlist_id', 'title', 'author', 'item_count', 'thumbnail_url')
+    KIND = 'playlist'
+
+    def __init__(self, playlist_id, title, author, item_count, thumbnail_url):
+        self.playlist_id = playlist_id
+        self.title = title
+        self.author = _intern(author)
+        self.item_count = item_count
+        self.thumbnail_url = _intern(thumbnail_url)
+
+    def to_json(self):
+        return {
+            'playlistName': self.title,
+            'playlistId': self.playlist_id,
+            'author': self.author,
+            'itemCount': self.item_count,
+            'thumbnailUrl': self.thumbnail_url
+        }
+
+MODEL_TYPES = (Song, Artist, Playlist)
+
+def _json_default(obj):
+    """Hook default= cho json.dumps: serialize các model khi ghi response / cache."""
+    if isinstance(obj, MODEL_TYPES):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _search_item_json(obj):
+    """Như _json_default nhưng thêm 'type', đúng định dạng item của /api/search."""
+    if isinstance(obj, MODEL_TYPES):
+        return dict(type=obj.KIND, **obj.to_json())
+    return _json_default(obj)
+
+def _song_json(song):
+    return song.to_json() if isinstance(song, Song) else song
+
+def _song_from_json(song):
+    """Ngược lại với _song_json: dict đọc từ JSON -> Song dùng chung."""
+    if not isinstance(song, dict):
+        return song
+    return Song.get(song.get('video_id'), song.get('title'), song.get('artist'), song.get('duration'), song.get('thumbnail_url'))
 
 
+# Serialize JSON: dùng orjson nếu có, ngược lại json của thư viện chuẩn; luôn ghi gọn (không indent)
+def _dumps(data, default=_json_default):
+    """data -> bytes UTF-8."""
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+def _dumps_text(data, default=_json_default):
+    return _dumps(data, default).decode('utf-8')
+
+def _loads(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+def _json_response(data, status=200, default=_json_default):
+    """Response JSON cho mọi route (thay cho jsonify / json.dumps riêng lẻ)."""
+    return Response(_dumps(data, default), status=status, mimetype='application/json')
+
+def _accepted_encoding():
+    """Mã hóa nén tốt nhất mà client chấp nhận (br, gzip), None nếu không có."""
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+# Tiện ích cho cache metadata (JSON)
+class JsonCacheEntry:
+    """
+    Response JSON đã serialize sẵn (UTF-8) của một mục cache, kèm ETag và Last-Modified tính trước.
+    updated_ns là thời điểm ghi (dùng làm version), expires_at là hạn của mục (None: không hết hạn).
+    Bản nén gzip / br được tạo ở lần đầu có client xin và giữ cùng entry.
+    data là dữ liệu gốc (bài hát là Song), để dùng lại mà không phải parse lại body.
+    """
+    __slots__ = ('data', 'body', 'etag', 'updated_ns', 'expires_at', 'last_modified', 'checked_at', 'video_ids', 'encoded')
+
+    def __init__(self, data, updated_ns, expires_at=None):
+        self.data = data
+        self.body = _dumps(data)
+        self.encoded = {}
+        # Các bài đầu danh sách (nếu có), để resolve trước URL stream khi entry được trả về
+        self.video_ids = _leading_video_ids(data)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.updated_ns = updated_ns
+        self.expires_at = expires_at
+        self.last_modified = datetime.fromtimestamp(updated_ns // 10**9, tz=timezone.utc)
+        self.checked_at = time.monotonic()
+
+    def is_fresh(self):
+        return self.expires_at is None or time.time() < self.expires_at
+
+    def variant(self, encoding):
+        """(body, etag) của bản nén theo encoding; tạo lần đầu rồi dùng lại."""
+        variant = self.encoded.get(encoding)
+        if variant is None:
+            if encoding == 'br':
+                body = brotli.compress(self.body, quality=JSON_BROTLI_QUALITY)
+            else:
+                body = gzip.compress(self.body, compresslevel=JSON_GZIP_LEVEL, mtime=0)
+            # Mỗi bản nén là một representation riêng nên cần ETag riêng
+            variant = self.encoded[encoding] = (body, f"{self.etag}-{encoding}")
+        return variant
+
+def _leading_video_ids(data, limit=STREAM_PREFETCH_COUNT):
+    """video_id của các bài đầu tiên trong dữ liệu dạng {'songs': [...]} hoặc danh sách bài hát."""
+    songs = data.get('songs') if isinstance(data, dict) else data
+    if not isinstance(songs, list):
+        return ()
+    songs = [_song_json(song) for song in songs[:limit]]
+    return tuple(song['video_id'] for song in songs if isinstance(song, dict) and song.get('video_id'))
+
+# Tầng bộ nhớ đặt trước metadata store: key -> JsonCacheEntry
+json_memory_cache = LRUCache(maxsize=JSON_MEMORY_CACHE_MAXSIZE)
+json_memory_lock = threading.Lock()
+
+def _load_json_cache_entry(key):
+    """
+    Trả JsonCacheEntry của key trong metadata store nếu còn hạn, ngược lại trả về None.
+    Hit trong bộ nhớ chỉ là một lần tra dict; version của dòng được kiểm tra lại
+    tối đa mỗi JSON_MEMORY_CACHE_STAT_INTERVAL giây để nhận thay đổi từ worker khác.
+    """
+    with json_memory_lock:
+        entry = json_memory_cache.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry.checked_at < JSON_MEMORY_CACHE_STAT_INTERVAL:
+        return entry if entry.is_fresh() else None
+
+    try:
+        version = metadata_store.version(key)
+        if version is None:
+            _invalidate_json_cache(key)
+            return None
+        updated_ns, expires_at = version
+        if entry is not None and entry.updated_ns == updated_ns:
+            entry.checked_at = now
+            return entry if entry.is_fresh() else None
+        if expires_at <= time.time():
+            return None
+        row = metadata_store.get(key)
+        if row is None:
+            return None
+        entry = JsonCacheEntry(*row)
+    except sqlite3.Error as e:
+        print(f"Lỗi khi đọc cache '{key}': {e}")
+        return None
+
+    with json_memory_lock:
+        json_memory_cache[key] = entry
+    return entry
+
+def _invalidate_json_cache(key):
+    with json_memory_lock:
+        json_memory_cache.pop(key, None)
+
+def _store_json_cache(key, data, ttl=METADATA_TTL):
+    """Ghi vào metadata store, đưa ngay bản serialize vào tầng bộ nhớ và cập nhật chỉ mục tìm kiếm."""
+    updated_ns, expires_at = metadata_store.put(key, data, ttl)
+    entry = JsonCacheEntry(data, updated_ns, expires_at)
+    with json_memory_lock:
+        json_memory_cache[key] = entry
+    background_executor.submit(_index_cached_data, key, data)
+    return entry
+
+def _cached_data(key):
+    """Dữ liệu đang lưu của key bất kể hạn, None nếu chưa có."""
+    try:
+        row = metadata_store.get(key)
+    except sqlite3.Error as e:
+        print(f"Lỗi khi đọc cache '{key}': {e}")
+        return None
+    return row[0] if row else None
+
+def _cache_age(key):
+    """Tuổi (giây) của mục cache, None nếu chưa có."""
+    version = metadata_store.version(key)
+    return time.time() - version[0] / 1e9 if version else None
+
+def _json_entry_response(entry):
+    """
+    Response cho một JsonCacheEntry với ETag (hash nội dung), Last-Modified (mtime của cache)
+    và Cache-Control. Body lớn được gửi bản nén sẵn nếu client chấp nhận (Accept-Encoding).
+    Trả 304 nếu request có If-None-Match / If-Modified-Since khớp.
+    """
+    body, etag = entry.body, entry.etag
+    encoding = _accepted_encoding() if len(body) >= JSON_COMPRESS_MIN_BYTES else None
+    if encoding:
+        body, etag = entry.variant(encoding)
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = (
+        f"public, max-age={CLIENT_CACHE_MAX_AGE}, "
+        f"stale-while-revalidate={CLIENT_CACHE_STALE_WHILE_REVALIDATE}"
+    )
+    return response.make_conditional(request)
+
+def _atomic_write_json(cache_filepath, data):
+    """Ghi JSON ra file tạm cùng thư mục rồi os.replace, người đọc không bao giờ thấy file ghi dở."""
+    directory = os.path.dirname(cache_filepath) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_filepath = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_dumps(data))
+        os.replace(temp_filepath, cache_filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+@contextmanager
+def _file_lock(key, timeout=CACHE_LOCK_TIMEOUT):
+    """
+    Khóa độc quyền giữa các worker gunicorn cho một key (dùng fcntl.flock).
+    Mỗi key một file khóa (tên theo md5 của key, chia thư mục con theo 2 ký tự đầu), nên một lần
+    dựng cache lâu không bắt các key khác phải chờ.
+    Yield True nếu lấy được khóa, False nếu hết thời gian chờ hoặc hệ điều hành không hỗ trợ.
+    """
+    if fcntl is None:
+        yield False
+        return
+
+    digest = hashlib.md5(key.encode()).hexdigest()
+    lock_folder = os.path.join(CACHE_LOCK_FOLDER, digest[:2])
+    os.makedirs(lock_folder, exist_ok=True)
+    with open(os.path.join(lock_folder, f"{digest}.lock"), 'a') as lock_file:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    print(f"Hết thời gian chờ khóa cho '{key}', tiếp tục không khóa.")
+                    yield False
+                    return
+                time.sleep(0.05)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SingleFlight:
+    """Gộp các lời gọi đồng thời cùng key: chỉ một luồng chạy fn, các luồng khác chờ kết quả."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key -> Future
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+        if is_leader:
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+        return future.result()
+
+cache_fill_flight = SingleFlight()
+
+# SQLite dùng chung giữa các worker (WAL: nhiều người đọc cùng lúc với một người ghi)
+_db_local = threading.local() # kết nối luồng hiện tại đang mượn từ pool
+_db_pool = [] # kết nối rảnh của process này
+_db_pool_lock = threading.Lock()
+_db_schema_pid = None # process đã chạy DB_SCHEMA
+
+DB_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS shared_datasets ('
+    'name TEXT PRIMARY KEY, version INTEGER NOT NULL, body BLOB NOT NULL, updated_at INTEGER NOT NULL)',
+    # Chỉ mục tìm kiếm cục bộ: search_docs giữ kết quả dạng /api/search, search_fts có cùng rowid
+    'CREATE TABLE IF NOT EXISTS search_docs ('
+    'id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, type TEXT NOT NULL, payload TEXT NOT NULL, updated_at INTEGER NOT NULL)',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(folded, tokenize='unicode61 remove_diacritics 2')",
+    # Các truy vấn tìm kiếm thành công, dùng cho gợi ý
+    'CREATE TABLE IF NOT EXISTS search_queries ('
+    'folded TEXT PRIMARY KEY, query TEXT NOT NULL, hits INTEGER NOT NULL, updated_at INTEGER NOT NULL)',
+    # Metadata store: nghệ sĩ / playlist và danh sách bài hát của từng cái trong track_lists
+    'CREATE TABLE IF NOT EXISTS artists ('
+    'channel_id TEXT PRIMARY KEY, name TEXT, thumbnail_url TEXT, description TEXT, '
+    'updated_at INTEGER NOT NULL, expires_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS playlists ('
+    'playlist_id TEXT PRIMARY KEY, title TEXT, description TEXT, thumbnail_url TEXT, total INTEGER, fetched_limit INTEGER, '
+    'updated_at INTEGER NOT NULL, expires_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS playlists_updated_at ON playlists (updated_at)',
+    # owner là key của nghệ sĩ / playlist; song chỉ có (JSON) khi bài không có video_id.
+    # Thông tin bài hát lưu theo từng owner: cùng một video_id ở nghệ sĩ và ở playlist có thể khác
+    # thumbnail / duration / cách ghi nghệ sĩ, và đọc lại phải ra đúng những gì owner đó đã ghi
+    'CREATE TABLE IF NOT EXISTS track_lists ('
+    'owner TEXT NOT NULL, position INTEGER NOT NULL, video_id TEXT, title TEXT, artist TEXT, duration TEXT, thumbnail_url TEXT, '
+    'song TEXT, PRIMARY KEY (owner, position)) WITHOUT ROWID',
+    # Các danh sách tổng hợp nhỏ (popular artists, made for you) lưu nguyên JSON
+    'CREATE TABLE IF NOT EXISTS collections ('
+    'name TEXT PRIMARY KEY, body TEXT NOT NULL, updated_at INTEGER NOT NULL, expires_at REAL NOT NULL)',
+    # Ảnh trong ARTIST_IMAGE_FOLDER: path tương đối (shard/tên file), kích thước, lần truy cập cuối, URL gốc.
+    # size NULL: ảnh đã được trả cho client nhưng chưa có (hoặc không còn) trên đĩa, tải lại từ source_url
+    'CREATE TABLE IF NOT EXISTS images ('
+    'path TEXT PRIMARY KEY, size INTEGER, last_access REAL NOT NULL, source_url TEXT)',
+    'CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)'
+)
+
+# Bảng kiểu cũ thiếu cột -> các bảng cần bỏ để DB_SCHEMA tạo lại (đều là cache, được dựng lại khi cần).
+# images được image_store.scan lúc khởi động ghi lại từ các file còn trên đĩa.
+DB_MIGRATIONS = (
+    ('images', 'source_url', ('images',)),
+    ('track_lists', 'thumbnail_url', ('track_lists', 'songs', 'artists', 'playlists')),
+)
+
+def _get_db():
+    """
+    Kết nối SQLite tới METADATA_DB_FILENAME cho luồng hiện tại, mượn từ pool của process.
+    Luồng request trả kết nối về pool khi request kết thúc (_release_db), nên server tạo một luồng
+    mỗi request vẫn dùng lại kết nối cũ thay vì mở mới; luồng background giữ kết nối của mình.
+    Schema chỉ được tạo một lần mỗi process.
+    """
+    global _db_pool, _db_schema_pid
+    conn = getattr(_db_local, 'conn', None)
+    pid = os.getpid()
+    if conn is not None and _db_local.pid == pid:
+        return conn
+
+    conn = None
+    with _db_pool_lock:
+        if _db_schema_pid != pid:
+            # Sau fork: kết nối của process cha không dùng được
+            _db_pool = []
+        elif _db_pool:
+            conn = _db_pool.pop()
+    if conn is None:
+        conn = sqlite3.connect(METADATA_DB_FILENAME, timeout=CACHE_LOCK_TIMEOUT, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with _db_pool_lock:
+            if _db_schema_pid != pid:
+                conn.execute('PRAGMA journal_mode=WAL')
+                for table, column, dropped in DB_MIGRATIONS:
+                    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+                    if columns and column not in columns:
+                        for name in dropped:
+                            conn.execute(f'DROP TABLE IF EXISTS {name}')
+                for statement in DB_SCHEMA:
+                    conn.execute(statement)
+                conn.commit()
+                _db_schema_pid = pid
+    _db_local.conn = conn
+    _db_local.pid = pid
+    return conn
+
+def _release_db():
+    """Trả kết nối luồng hiện tại đang mượn về pool (đóng nếu pool đã đủ)."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        return
+    _db_local.conn = None
+    if _db_local.pid != os.getpid():
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+@app.teardown_request
+def _release_request_db(exc=None):
+    _release_db()
+
+
+class SharedDataset:
+    """Bản đã nạp của một dataset dùng chung: dữ liệu, response serialize sẵn và version tương ứng."""
+    __slots__ = ('version', 'data', 'entry')
+
+    def __init__(self, version, data, entry):
+        self.version = version
+        self.data = data
+        self.entry = entry
+
+
+class SharedDatasetStore:
+    """
+    Dataset JSON dùng chung giữa các worker, lưu trong bảng shared_datasets kèm số version.
+    Mỗi lần đọc chỉ so version (một SELECT theo khóa chính); dữ liệu chỉ được parse lại
+    và serialize thành JsonCacheEntry khi worker khác đã ghi version mới.
+    """
+
+    def __init__(self):
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """SharedDataset mới nhất của name, None nếu chưa có."""
+        conn = _get_db()
+        row = conn.execute('SELECT version FROM shared_datasets WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        loaded = self._loaded.get(name)
+        if loaded is not None and loaded.version == row[0]:
+            return loaded
+
+        row = conn.execute('SELECT version, body, updated_at FROM shared_datasets WHERE name = ?', (name,)).fetchone()
+        data = _loads(row[1])
+        if isinstance(data, dict) and isinstance(data.get('songs'), list):
+            data['songs'] = [_song_from_json(song) for song in data['songs']]
+        loaded = SharedDataset(row[0], data, None)
+        loaded.entry = JsonCacheEntry(loaded.data, row[2])
+        with self._lock:
+            current = self._loaded.get(name)
+            if current is None or current.version < loaded.version:
+                self._loaded[name] = loaded
+        return loaded
+
+    def publish(self, name, data):
+        """Ghi dữ liệu mới và tăng version; mọi worker thấy ngay ở lần đọc kế tiếp."""
+        body = _dumps(data)
+        conn = _get_db()
+        with conn:
+            conn.execute(
+                'INSERT INTO shared_datasets (name, version, body, updated_at) VALUES (?, 1, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET version = version + 1, body = excluded.body, updated_at = excluded.updated_at',
+                (name, body, time.time_ns())
+            )
+        return self.get(name)
+
+    def age(self, name):
+        """Tuổi (giây) của dataset, None nếu chưa có."""
+        row = _get_db().execute('SELECT updated_at FROM shared_datasets WHERE name = ?', (name,)).fetchone()
+        return time.time() - row[0] / 1e9 if row else None
+
+shared_store = SharedDatasetStore()
+
+
+class MetadataStore:
+    """
+    Cache metadata trong metadata.db, thay cho các file JSON trước đây.
+    Key: 'artist:<channel_id>', 'playlist:<playlist_id>' (chuẩn hóa vào artists / playlists / track_lists)
+    và 'collection:<tên>' (danh sách tổng hợp nhỏ, lưu nguyên JSON).
+    Mỗi dòng có updated_at (ns, dùng làm version cho tầng bộ nhớ) và expires_at (TTL riêng từng dòng).
+    """
+
+    # loại key -> (bảng, khóa chính)
+    TABLES = {'artist': ('artists', 'channel_id'), 'playlist': ('playlists', 'playlist_id'), 'collection': ('collections', 'name')}
+
+    def _table(self, key):
+        kind, ident = key.split(':', 1)
+        table, column = self.TABLES[kind]
+        return kind, ident, table, column
+
+    def version(self, key):
+        """(updated_at, expires_at) của key, None nếu chưa có."""
+        _, ident, table, column = self._table(key)
+        return _get_db().execute(f'SELECT updated_at, expires_at FROM {table} WHERE {column} = ?', (ident,)).fetchone()
+
+    def get(self, key):
+        """(dữ liệu, updated_at, expires_at) của key bất kể hạn, None nếu chưa có."""
+        kind, ident, table, column = self._table(key)
+        conn = _get_db()
+        if kind == 'collection':
+            row = conn.execute('SELECT body, updated_at, expires_at FROM collections WHERE name = ?', (ident,)).fetchone()
+            return (_loads(row[0]), row[1], row[2]) if row else None
+        if kind == 'artist':
+            row = conn.execute(
+                'SELECT name, thumbnail_url, description, updated_at, expires_at FROM artists WHERE channel_id = ?', (ident,)
+            ).fetchone()
+            if row is None:
+                return None
+            data = {'artistName': row[0], 'artistThumbnail': row[1], 'description': row[2], 'songs': self._tracks(conn, key)}
+            return data, row[3], row[4]
+        row = conn.execute(
+            'SELECT title, description, thumbnail_url, total, fetched_limit, updated_at, expires_at FROM playlists WHERE playlist_id = ?',
+            (ident,)
+        ).fetchone()
+        if row is None:
+            return None
+        data = {
+            'id': ident, 'title': row[0], 'description': row[1], 'thumbnail_url': row[2],
+            'total': row[3], 'fetched_limit': row[4], 'songs': self._tracks(conn, key)
+        }
+        return data, row[5], row[6]
+
+    @staticmethod
+    def _tracks(conn, owner):
+        songs = []
+        rows = conn.execute(
+            'SELECT video_id, song, title, artist, duration, thumbnail_url FROM track_lists WHERE owner = ? ORDER BY position',
+            (owner,)
+        )
+        for video_id, song, title, artist, duration, thumbnail_url in rows:
+            if song is not None:
+                songs.append(_song_from_json(_loads(song)))
+            else:
+                songs.append(Song.get(video_id, title, artist, duration, thumbnail_url))
+        return songs
+
+    def put(self, key, data, ttl=METADATA_TTL, updated_ns=None):
+        """Ghi dữ liệu của key (một transaction), trả (updated_at, expires_at)."""
+        kind, ident, table, column = self._table(key)
+        updated_ns = updated_ns or time.time_ns()
+        expires_at = updated_ns / 1e9 + ttl
+        conn = _get_db()
+        with conn:
+            if kind == 'collection':
+                conn.execute(
+                    'INSERT OR REPLACE INTO collections (name, body, updated_at, expires_at) VALUES (?, ?, ?, ?)',
+                    (ident, _dumps_text(data), updated_ns, expires_at)
+                )
+            elif kind == 'artist':
+                conn.execute(
+                    'INSERT OR REPLACE INTO artists (channel_id, name, thumbnail_url, description, updated_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (ident, data.get('artistName'), data.get('artistThumbnail'), data.get('description'), updated_ns, expires_at)
+                )
+                self._put_tracks(conn, key, data.get('songs', []))
+            else:
+                conn.execute(
+                    'INSERT OR REPLACE INTO playlists (playlist_id, title, description, thumbnail_url, total, fetched_limit, updated_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (ident, data.get('title'), data.get('description'), data.get('thumbnail_url'),
+                     data.get('total'), data.get('fetched_limit'), updated_ns, expires_at)
+                )
+                self._put_tracks(conn, key, data.get('songs', []))
+        return updated_ns, expires_at
+
+    @staticmethod
+    def _put_tracks(conn, owner, songs):
+        conn.execute('DELETE FROM track_lists WHERE owner = ?', (owner,))
+        rows = []
+        for position, song in enumerate(songs):
+            song = _song_json(song)
+            if not song.get('video_id'):
+                rows.append((owner, position, None, None, None, None, None, _dumps_text(song)))
+                continue
+            rows.append((owner, position, song['video_id'], song.get('title'), song.get('artist'),
+                         song.get('duration'), song.get('thumbnail_url'), None))
+        conn.executemany(
+            'INSERT INTO track_lists (owner, position, video_id, title, artist, duration, thumbnail_url, song) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+    def ages(self, kind):
+        """[(id, tuổi tính bằng giây)] của mọi dòng loại kind."""
+        table, column = self.TABLES[kind]
+        now = time.time()
+        return [(ident, now - updated_at / 1e9) for ident, updated_at in _get_db().execute(f'SELECT {column}, updated_at FROM {table}')]
+
+    def oldest_age(self, kind):
+        table, _ = self.TABLES[kind]
+        row = _get_db().execute(f'SELECT MIN(updated_at) FROM {table}').fetchone()
+        return time.time() - row[0] / 1e9 if row[0] is not None else 0
+
+    def keys(self):
+        for kind, (table, column) in self.TABLES.items():
+            for (ident,) in _get_db().execute(f'SELECT {column} FROM {table}').fetchall():
+                yield f"{kind}:{ident}"
+
+metadata_store = MetadataStore()
+
+def _get_or_fetch_json_entry(key, fetch):
+    """
+    Trả JsonCacheEntry từ cache nếu còn mới. Khi miss, chỉ một request (trong mọi worker)
+    gọi fetch() và ghi cache; các request đồng thời khác chờ và dùng lại kết quả đó.
+    """
+    entry = _load_json_cache_entry(key)
+    if entry is not None:
+        return entry
+
+    def fill():
+        with _file_lock(key):
+            # Worker khác có thể vừa ghi xong cache trong lúc chờ khóa
+            entry = _load_json_cache_entry(key)
+            if entry is not None:
+                return entry
+            data = fetch()
+            try:
+                entry = _store_json_cache(key, data)
+                print(f"Đã lưu cache mới cho '{key}'.")
+                return entry
+            except sqlite3.Error as e:
+                print(f"Lỗi khi ghi cache '{key}': {e}")
+                return JsonCacheEntry(data, time.time_ns())
+
+    return cache_fill_flight.do(key, fill)
+
 
 # Hàm search
 def _parse_search_result_item(item):
@@ -61,18 +1074,16 @@ def _parse_search_result_item(item):
         # Logic parse bài hát từ kết quả tìm kiếm
         # Nó gần giống với hàm _parse_song_from_ytmusic nhưng độc lập
         original_thumbnail_url = item["thumbnails"][-1].get("url", "") if item.get("thumbnails") else ""
-        local_thumbnail_path = download_and_save_image(original_thumbnail_url, item.get("videoId", ""))
         artists = item.get("artists", [])
         artist_names = ", ".join([artist.get("name", "") for artist in artists])
 
-        parsed_item = {
-            'type': 'song',
-            'video_id': item.get("videoId", ""),
-            'title': item.get("title", "Unknown Title"),
-            'artist': artist_names or "Unknown Artist",
-            'thumbnail_url': f"{baseUrl}{local_thumbnail_path}" if local_thumbnail_path else "",
-            'duration': item.get("duration", "N/A")
-        }
+        parsed_item = Song.get(
+            item.get("videoId", ""),
+            item.get("title", "Unknown Title"),
+            artist_names or "Unknown Artist",
+            item.get("duration", "N/A"),
+            resolve_thumbnail_url(original_thumbnail_url, item.get("videoId", ""))
+        )
 
     elif result_type == 'artist':
         channel_id = item.get('browseId')
@@ -80,216 +1091,728 @@ def _parse_search_result_item(item):
         # 2. CHỈ xử lý nếu channelId tồn tại và không rỗng
         if channel_id:
             original_thumbnail_url = item['thumbnails'][-1]['url'] if item.get('thumbnails') else ''
-            local_thumbnail_path = download_and_save_image(original_thumbnail_url, channel_id)
-            parsed_item = {
-                'type': 'artist',
-                'artistName': item.get('artist'),
-                'channelId': channel_id, # Đảm bảo không bao giờ là null
-                'thumbnailUrl': f"{baseUrl}{local_thumbnail_path}" if local_thumbnail_path else ""
-            }
+            parsed_item = Artist(
+                channel_id, # Đảm bảo không bao giờ là null
+                item.get('artist'),
+                resolve_thumbnail_url(original_thumbnail_url, channel_id)
+            )
 
     elif result_type == 'playlist':
         original_thumbnail_url = item['thumbnails'][-1]['url'] if item.get('thumbnails') else ''
-        local_thumbnail_path = download_and_save_image(original_thumbnail_url, item.get('browseId', ''))
-        parsed_item = {
-            'type': 'playlist',
-            'playlistName': item.get('title'),
-            'playlistId': item.get('browseId'),
-            'author': item.get('author'),
-            'itemCount': item.get('itemCount'),
-            'thumbnailUrl': f"{baseUrl}{local_thumbnail_path}" if local_thumbnail_path else ""
-        }
+        parsed_item = Playlist(
+            item.get('browseId'),
+            item.get('title'),
+            item.get('author'),
+            item.get('itemCount'),
+            resolve_thumbnail_url(original_thumbnail_url, item.get('browseId', ''))
+        )
     
     return parsed_item
 
+def _search_group(query, search_filter, limit):
+    """Gọi yt.search cho một nhóm kết quả và định dạng lại từng mục."""
+    parsed_items = []
+    for item in yt.search(query, filter=search_filter, limit=limit) or []:
+        parsed_item = _parse_search_result_item(item)
+        if parsed_item: parsed_items.append(parsed_item)
+    return parsed_items
+
+def _iter_search_groups(query, timeout=SEARCH_CALL_TIMEOUT):
+    """
+    Gửi song song các tìm kiếm trong SEARCH_GROUPS lên upstream_executor và
+    yield (nhóm, kết quả, lỗi) ngay khi từng nhóm hoàn tất.
+    Nhóm bị lỗi hoặc quá deadline sẽ có kết quả rỗng và lỗi tương ứng.
+    """
+    futures = {
+        upstream_executor.submit(_search_group, query, search_filter, limit): search_filter
+        for search_filter, limit in SEARCH_GROUPS
+    }
+    deadline = time.monotonic() + timeout
+    pending = set(futures)
+
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            group = futures[future]
+            try:
+                yield group, future.result(), None
+            except Exception as e:
+                print(f"Lỗi khi tìm kiếm nhóm '{group}': {e}")
+                yield group, [], str(e)
+
+    # Những nhóm còn lại đã quá deadline
+    for future in pending:
+        future.cancel()
+        print(f"Tìm kiếm nhóm '{futures[future]}' quá {timeout}s, bỏ qua.")
+        yield futures[future], [], 'timeout'
+
+def _format_search_event(stream_mode, event, payload):
+    """Định dạng một bản ghi cho chế độ stream NDJSON hoặc SSE."""
+    data = _dumps_text(payload, default=_search_item_json)
+    if stream_mode == 'sse':
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+def _normalize_query(query):
+    """
+    Chuẩn hóa truy vấn làm key cho cache: chữ thường, gộp khoảng trắng
+    và bỏ dấu tiếng Việt (kể cả "đ" -> "d").
+    """
+    folded = unicodedata.normalize('NFD', query.casefold()).replace('đ', 'd')
+    folded = ''.join(c for c in folded if not unicodedata.combining(c))
+    return ' '.join(folded.split())
+
+class LocalSearchIndex:
+    """
+    Chỉ mục FTS5 (trong metadata.db) của bài hát, nghệ sĩ và playlist mà server đã lấy về.
+    Văn bản được chuẩn hóa bằng _normalize_query nên tìm được không dấu; mỗi từ khớp theo tiền tố.
+    Kết quả lưu sẵn đúng định dạng item của /api/search.
+    """
+
+    # nhóm trong SEARCH_GROUPS -> type của item
+    GROUP_TYPES = {'artists': 'artist', 'songs': 'song', 'playlists': 'playlist'}
+
+    def add_songs(self, songs):
+        songs = [_song_json(song) for song in songs]
+        self._upsert([
+            (f"song:{song['video_id']}", 'song', f"{song.get('title', '')} {song.get('artist', '')}", dict(song, type='song'))
+            for song in songs if song and song.get('video_id')
+        ])
+
+    def add_artists(self, artists):
+        self._upsert([
+            (f"artist:{artist['channelId']}", 'artist', artist.get('artistName') or '', dict(artist, type='artist'))
+            for artist in artists if artist and artist.get('channelId')
+        ])
+
+    def add_playlists(self, playlists):
+        self._upsert([
+            (f"playlist:{playlist['playlistId']}", 'playlist', f"{playlist.get('playlistName') or ''} {playlist.get('author') or ''}", dict(playlist, type='playlist'))
+            for playlist in playlists if playlist and playlist.get('playlistId')
+        ])
+
+    def _upsert(self, docs):
+        if not docs:
+            return
+        conn = _get_db()
+        now = time.time_ns()
+        with conn:
+            for key, doc_type, text, payload in docs:
+                row = conn.execute('SELECT id FROM search_docs WHERE key = ?', (key,)).fetchone()
+                payload = _dumps_text(payload)
+                if row is None:
+                    doc_id = conn.execute(
+                        'INSERT INTO search_docs (key, type, payload, updated_at) VALUES (?, ?, ?, ?)',
+                        (key, doc_type, payload, now)
+                    ).lastrowid
+                else:
+                    doc_id = row[0]
+                    conn.execute('UPDATE search_docs SET payload = ?, updated_at = ? WHERE id = ?', (payload, now, doc_id))
+                    conn.execute('DELETE FROM search_fts WHERE rowid = ?', (doc_id,))
+                conn.execute('INSERT INTO search_fts (rowid, folded) VALUES (?, ?)', (doc_id, _normalize_query(text)))
+
+    @staticmethod
+    def _match_expression(query):
+        """Mỗi từ của truy vấn (đã chuẩn hóa) thành một prefix query: "tu"* "khoa"*."""
+        tokens = re.findall(r'\w+', _normalize_query(query))
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def search_group(self, query, group, limit):
+        expression = self._match_expression(query)
+        if not expression:
+            return []
+        rows = _get_db().execute(
+            'SELECT d.payload FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid '
+            'WHERE search_fts MATCH ? AND d.type = ? ORDER BY search_fts.rank LIMIT ?',
+            (expression, self.GROUP_TYPES[group], limit)
+        ).fetchall()
+        return [_loads(payload) for (payload,) in rows]
+
+    def search(self, query):
+        """Kết quả cục bộ theo nhóm, cùng định dạng với _load_search_groups."""
+        return {
+            'groups': {group: self.search_group(query, group, limit) for group, limit in SEARCH_GROUPS},
+            'errors': []
+        }
+
+    def is_empty(self):
+        return _get_db().execute('SELECT 1 FROM search_docs LIMIT 1').fetchone() is None
+
+search_index = LocalSearchIndex()
+
+def _index_cached_data(key, data):
+    """Đưa dữ liệu vừa ghi vào metadata store vào chỉ mục tìm kiếm cục bộ."""
+    try:
+        kind, ident = key.split(':', 1)
+        if key == POPULAR_ARTISTS_KEY:
+            search_index.add_artists(data.get('artists', []))
+        elif key == MADE_FOR_YOU_KEY:
+            search_index.add_playlists([
+                {'playlistName': p.get('title'), 'playlistId': p.get('id'), 'author': None,
+                 'itemCount': p.get('trackCount'), 'thumbnailUrl': p.get('thumbnail_url')}
+                for p in data.get('playlists', [])
+            ])
+        elif kind == 'artist':
+            search_index.add_artists([{'artistName': data.get('artistName'), 'channelId': ident,
+                                       'thumbnailUrl': data.get('artistThumbnail')}])
+            search_index.add_songs(data.get('songs', []))
+        elif kind == 'playlist':
+            search_index.add_playlists([{'playlistName': data.get('title'), 'playlistId': data.get('id'), 'author': None,
+                                         'itemCount': data.get('total'), 'thumbnailUrl': data.get('thumbnail_url')}])
+            search_index.add_songs(data.get('songs', []))
+    except (sqlite3.Error, AttributeError, KeyError) as e:
+        print(f"Lỗi khi cập nhật chỉ mục tìm kiếm cho '{key}': {e}")
+
+def bootstrap_search_index():
+    """Lúc khởi động: nếu chỉ mục còn trống, dựng từ metadata store và trending đã có (một worker làm)."""
+    with _file_lock('search_index_bootstrap', timeout=0) as locked:
+        if not locked or not search_index.is_empty():
+            return
+        keys = list(metadata_store.keys())
+        for key in keys:
+            data = _cached_data(key)
+            if data is not None:
+                _index_cached_data(key, data)
+        trending = shared_store.get('trending')
+        if trending is not None:
+            search_index.add_songs(trending.data['songs'])
+        print(f"Đã dựng chỉ mục tìm kiếm cục bộ từ {len(keys)} mục cache.")
+    suggestion_index.sync()
+
+def _fill_from_local_index(query, search_result):
+    """
+    Thay các nhóm bị lỗi / quá thời gian bằng kết quả từ chỉ mục cục bộ.
+    Trả về (kết quả theo nhóm, có dùng chỉ mục cục bộ hay không).
+    """
+    groups = dict(search_result['groups'])
+    failed_groups = {error.split(':', 1)[0] for error in search_result['errors']}
+    used_local = False
+    for group, limit in SEARCH_GROUPS:
+        if group in failed_groups:
+            try:
+                groups[group] = search_index.search_group(query, group, limit)
+                used_local = used_local or bool(groups[group])
+            except sqlite3.Error as e:
+                print(f"Lỗi khi tìm trong chỉ mục cục bộ: {e}")
+    return groups, used_local
+
+class SuggestionIndex:
+    """
+    Gợi ý theo tiền tố (đã chuẩn hóa không dấu) cho /api/suggest.
+    Mỗi cụm từ được ghi theo cả chuỗi và từ mỗi đầu từ, nên "tung" gợi ý được "Sơn Tùng M-TP".
+    Các đầu từ nằm trong một mảng đã sắp xếp và được tìm bằng bisect (gọn hơn nhiều so với trie
+    dict lồng nhau); tiền tố rất ngắn khớp quá nhiều cụm nên có top-k tính sẵn.
+    Tối đa SUGGEST_MAX_PHRASES cụm từ, vượt quá thì bỏ các cụm trọng số thấp nhất.
+    Trọng số chỉ tăng. Dữ liệu lấy từ search_docs (tên bài hát, nghệ sĩ, playlist đã cache)
+    và search_queries (truy vấn thành công), nạp thêm định kỳ nên thấy được dữ liệu do worker khác ghi.
+    """
+
+    def __init__(self):
+        self._weights = {} # cụm từ đã chuẩn hóa -> (trọng số, cụm từ hiển thị)
+        self._starts = [] # (đầu từ, cụm từ đã chuẩn hóa), đã sắp xếp
+        self._top = {} # tiền tố ngắn -> top-k cụm từ đã chuẩn hóa
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock() # một lượt nạp / dựng lại tại một thời điểm, suggest không cần chờ
+        self._synced_docs_at = 0
+        self._synced_queries_at = 0
+        self._last_sync = 0
+        self._syncing = False
+
+    def suggest(self, prefix, limit):
+        self.schedule_sync()
+        folded = _normalize_query(prefix)
+        if not folded:
+            return []
+        # Đọc không cần khóa: _rebuild thay cả ba object chứ không sửa tại chỗ
+        weights, starts, top = self._weights, self._starts, self._top
+        if len(folded) <= SUGGEST_PRECOMPUTED_PREFIX:
+            keys = top.get(folded, ())
+        else:
+            lo = bisect_left(starts, (folded,))
+            hi = bisect_left(starts, (folded + '\uffff',), lo)
+            matches = {key for _, key in starts[lo:hi] if key in weights}
+            keys = heapq.nsmallest(limit, matches, key=lambda key: (-weights[key][0], key))
+        return [weights[key][1] for key in keys[:limit] if key in weights]
+
+    @staticmethod
+    def _word_starts(key):
+        words = key.split(' ')
+        return [' '.join(words[i:]) for i in range(len(words))]
+
+    def _add(self, text, weight):
+        """Nâng trọng số của cụm từ lên weight (không bao giờ giảm); có hiệu lực sau _rebuild."""
+        key = _normalize_query(text)
+        if not key:
+            return False
+        current = self._weights.get(key)
+        if current is not None and current[0] >= weight:
+            return False
+        self._weights[key] = (weight, text.strip())
+        return True
+
+    def _rebuild(self):
+        """Cắt bớt theo SUGGEST_MAX_PHRASES rồi dựng lại mảng đầu từ và top-k tiền tố ngắn."""
+        weights = self._weights
+        if len(weights) > SUGGEST_MAX_PHRASES:
+            weights = dict(heapq.nlargest(SUGGEST_MAX_PHRASES, weights.items(), key=lambda item: item[1][0]))
+        ranked = sorted(weights, key=lambda key: (-weights[key][0], key))
+        starts = []
+        top = {}
+        for key in ranked:
+            for start in self._word_starts(key):
+                starts.append((start, key))
+                for length in range(1, min(len(start), SUGGEST_PRECOMPUTED_PREFIX) + 1):
+                    keys = top.setdefault(start[:length], [])
+                    if len(keys) < SUGGEST_TOP_K and key not in keys:
+                        keys.append(key)
+        starts.sort()
+        self._weights, self._starts, self._top = weights, starts, top
+
+    def record_query(self, query):
+        """Ghi nhận một truy vấn tìm kiếm thành công (chạy ở background)."""
+        folded = _normalize_query(query)
+        if not folded:
+            return
+        try:
+            conn = _get_db()
+            with conn:
+                conn.execute(
+                    'INSERT INTO search_queries (folded, query, hits, updated_at) VALUES (?, ?, 1, ?) '
+                    'ON CONFLICT(folded) DO UPDATE SET hits = hits + 1, query = excluded.query, updated_at = excluded.updated_at',
+                    (folded, query.strip(), time.time_ns())
+                )
+        except sqlite3.Error as e:
+            print(f"Lỗi khi lưu truy vấn gợi ý: {e}")
+
+    def schedule_sync(self):
+        """Nạp thêm dữ liệu ở background nếu lần nạp trước đã quá SUGGEST_SYNC_INTERVAL."""
+        now = time.monotonic()
+        with self._lock:
+            if self._syncing or now - self._last_sync < SUGGEST_SYNC_INTERVAL:
+                return
+            self._syncing = True
+        background_executor.submit(self.sync)
+
+    def sync(self):
+        """Nạp các tài liệu / truy vấn mới hơn lần nạp trước vào chỉ mục gợi ý."""
+        try:
+            conn = _get_db()
+            docs = conn.execute(
+                'SELECT type, payload, updated_at FROM search_docs WHERE updated_at > ? ORDER BY updated_at',
+                (self._synced_docs_at,)
+            ).fetchall()
+            queries = conn.execute(
+                'SELECT query, hits, updated_at FROM search_queries WHERE updated_at > ? ORDER BY updated_at',
+                (self._synced_queries_at,)
+            ).fetchall()
+            changed = False
+            with self._sync_lock:
+                for doc_type, payload, updated_at in docs:
+                    item = _loads(payload)
+                    weight = SUGGEST_TYPE_WEIGHTS.get(doc_type, 1)
+                    if doc_type == 'song':
+                        changed |= self._add(item.get('title') or '', weight)
+                        for artist_name in (item.get('artist') or '').split(', '):
+                            changed |= self._add(artist_name, SUGGEST_TYPE_WEIGHTS['artist'])
+                    elif doc_type == 'artist':
+                        changed |= self._add(item.get('artistName') or '', weight)
+                    elif doc_type == 'playlist':
+                        changed |= self._add(item.get('playlistName') or '', weight)
+                    self._synced_docs_at = updated_at
+                for query, hits, updated_at in queries:
+                    changed |= self._add(query, hits * SUGGEST_QUERY_WEIGHT)
+                    self._synced_queries_at = updated_at
+                if changed:
+                    self._rebuild()
+        except sqlite3.Error as e:
+            print(f"Lỗi khi nạp dữ liệu gợi ý: {e}")
+        finally:
+            with self._lock:
+                self._last_sync = time.monotonic()
+                self._syncing = False
+
+suggestion_index = SuggestionIndex()
+
+def _load_search_groups(query):
+    """
+    Chạy tìm kiếm song song và trả về {'groups': {nhóm: kết quả}, 'errors': [...]}.
+    Raise RuntimeError nếu tất cả các nhóm đều lỗi.
+    """
+    grouped_results = {}
+    errors = []
+    for group, items, error in _iter_search_groups(query):
+        grouped_results[group] = items
+        if error:
+            errors.append(f"{group}: {error}")
+        else:
+            print(f"-> Tìm thấy {len(items)} kết quả {group}.")
+
+    if len(errors) == len(SEARCH_GROUPS):
+        raise RuntimeError('; '.join(errors))
+    return {'groups': grouped_results, 'errors': errors}
+
+# Chỉ cache kết quả khi cả 3 nhóm đều thành công
+search_cache = StaleWhileRevalidateCache(
+    maxsize=SEARCH_CACHE_MAXSIZE,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL,
+    is_cacheable=lambda value: not value['errors']
+)
+
+def _stream_search(query, stream_mode):
+    """Flush từng nhóm kết quả ngay khi tìm kiếm của nhóm đó xong."""
+    cache_key = _normalize_query(query)
+    cached_value = search_cache.get_if_present(cache_key, lambda: _load_search_groups(query))
+    if cached_value is not None:
+        for group, _ in SEARCH_GROUPS:
+            payload = {'group': group, 'results': cached_value['groups'].get(group, [])}
+            yield _format_search_event(stream_mode, group, payload)
+        yield _format_search_event(stream_mode, 'done', {'done': True})
+        return
+
+    grouped_results = {}
+    errors = []
+    for group, items, error in _iter_search_groups(query):
+        grouped_results[group] = items
+        payload = {'group': group, 'results': items}
+        if error:
+            errors.append(f"{group}: {error}")
+            payload['error'] = error
+            local_groups, used_local = _fill_from_local_index(query, {'groups': {}, 'errors': [f"{group}: {error}"]})
+            if used_local:
+                payload['results'] = local_groups[group]
+                payload['source'] = 'local'
+        yield _format_search_event(stream_mode, group, payload)
+    search_cache.put(cache_key, {'groups': grouped_results, 'errors': errors})
+    yield _format_search_event(stream_mode, 'done', {'done': True})
+
 @app.route('/api/search', methods=['GET'])
 def search_all():
+    """
+    Tìm kiếm nghệ sĩ, bài hát và playlist song song.
+    Tham số tùy chọn stream=ndjson|sse: trả từng nhóm kết quả ngay khi có.
+    Tham số tùy chọn source=local: chỉ tìm trong chỉ mục cục bộ (không gọi API).
+    Nhóm nào lỗi hoặc quá thời gian sẽ được thay bằng kết quả cục bộ (response có 'source': 'local').
+    """
     query = request.args.get('q', '')
-    if not query or not yt:
-        return jsonify({'results': []})
+    if not query:
+        return _json_response({'results': []})
+
+    if request.args.get('source') == SEARCH_LOCAL_ONLY or not yt:
+        try:
+            grouped_results = search_index.search(query)['groups']
+        except sqlite3.Error as e:
+            return _json_response({'error': f"Lỗi khi tìm kiếm: {str(e)}"}), 500
+        final_results = [item for group, _ in SEARCH_GROUPS for item in grouped_results[group]]
+        return _json_response({'results': final_results, 'source': 'local'})
+
+    stream_mode = request.args.get('stream', '').lower()
+    if stream_mode in ('ndjson', 'sse'):
+        print(f"\nĐang stream kết quả tìm kiếm ({stream_mode}) cho: '{query}'")
+        mimetype = 'text/event-stream' if stream_mode == 'sse' else 'application/x-ndjson'
+        return Response(
+            stream_with_context(_stream_search(query, stream_mode)),
+            mimetype=mimetype,
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
 
     try:
         print(f"\nĐang thực hiện tìm kiếm thông minh cho: '{query}'")
-        # Thực hiện 3 tìm kiếm riêng biệt
-        artist_results = yt.search(query, filter='artists', limit=3)
-        song_results = yt.search(query, filter='songs', limit=5)
-        playlist_results = yt.search(query, filter='playlists', limit=3)
+        # Cache theo truy vấn đã chuẩn hóa; miss thì chạy 3 tìm kiếm song song
+        try:
+            search_result = search_cache.get(_normalize_query(query), lambda: _load_search_groups(query))
+        except RuntimeError as e:
+            # Mọi nhóm đều lỗi: dùng chỉ mục cục bộ nếu có kết quả
+            search_result = {'groups': {}, 'errors': [f"{group}: {e}" for group, _ in SEARCH_GROUPS]}
+            grouped_results, used_local = _fill_from_local_index(query, search_result)
+            if not used_local:
+                return _json_response({'error': f"Lỗi khi tìm kiếm: {str(e)}"}), 500
+        else:
+            grouped_results, used_local = _fill_from_local_index(query, search_result)
 
+        # Giữ thứ tự: nghệ sĩ, bài hát, playlist
         final_results = []
+        for group, _ in SEARCH_GROUPS:
+            final_results.extend(grouped_results.get(group, []))
 
-        # Ưu tiên kết quả nghệ sĩ
-        if artist_results:
-            print(f"-> Tìm thấy {len(artist_results)} kết quả nghệ sĩ.")
-            for item in artist_results:
-                parsed_item = _parse_search_result_item(item)
-                if parsed_item: final_results.append(parsed_item)
-
-        # Thêm kết quả bài hát
-        if song_results:
-            print(f"-> Tìm thấy {len(song_results)} kết quả bài hát.")
-            for item in song_results:
-                parsed_item = _parse_search_result_item(item)
-                if parsed_item: final_results.append(parsed_item)
-        
-        # Thêm kết quả playlist
-        if playlist_results:
-            print(f"-> Tìm thấy {len(playlist_results)} kết quả playlist.")
-            for item in playlist_results:
-                parsed_item = _parse_search_result_item(item)
-                if parsed_item: final_results.append(parsed_item)
-        
         print("--- Tìm kiếm hoàn tất ---")
-        return Response(json.dumps({'results': final_results}, ensure_ascii=False), mimetype='application/json')
+        if final_results and not search_result['errors']:
+            background_executor.submit(suggestion_index.record_query, query)
+        response_data = {'results': final_results}
+        if used_local:
+            response_data['source'] = 'local'
+        return _json_response(response_data, default=_search_item_json)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f"Lỗi khi tìm kiếm: {str(e)}"}), 500
+        return _json_response({'error': f"Lỗi khi tìm kiếm: {str(e)}"}), 500
+
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    """
+    Gợi ý khi gõ: trả các tên bài hát, nghệ sĩ, playlist và truy vấn phổ biến bắt đầu bằng q
+    (khớp cả đầu từ, không dấu). Chỉ đọc chỉ mục gợi ý trong bộ nhớ, không gọi API.
+    """
+    query = request.args.get('q', '')
+    try:
+        limit = min(max(int(request.args.get('limit', 8)), 1), SUGGEST_TOP_K)
+    except ValueError:
+        limit = 8
+    return _json_response({'query': query, 'suggestions': suggestion_index.suggest(query, limit)})
 
 
 # Các hàm tạo playlist 
+def _playlist_details_key(playlist_id):
+    return f"playlist:{playlist_id}"
+
+def _fetch_playlist_details(playlist_id, limit=PLAYLIST_PAGE_SIZE):
+    """Lấy chi tiết playlist (tối đa limit bài đầu) từ API và định dạng lại danh sách bài hát."""
+    return _build_playlist_details(yt.get_playlist(playlistId=playlist_id, limit=limit), limit)
+
+def _build_playlist_details(playlist_data, limit):
+    """
+    Dựng dữ liệu cache của /api/playlist/<id> từ kết quả get_playlist(limit=limit) đã có sẵn.
+    fetched_limit được lưu lại để biết cache đã chứa hết playlist hay cần lấy thêm.
+    """
+    # Trích xuất thông tin playlist
+    thumbnail_url = playlist_data.get('thumbnails', [])[-1]['url'] if playlist_data.get('thumbnails') else ""
+
+    # Trích xuất và định dạng lại danh sách bài hát
+    songs = []
+    for track in playlist_data.get('tracks', []):
+        artists = track.get("artists", [])
+        artist_names = ", ".join(artist.get("name", "Unknown") for artist in artists) if artists else "Unknown Artist"
+        track_thumbnail = track.get('thumbnails', [])[-1]['url'] if track.get('thumbnails') else ""
+        
+        songs.append(Song.get(
+            track.get("videoId", ""),
+            track.get("title", "Unknown Title"),
+            artist_names,
+            track.get("duration", "N/A"),
+            track_thumbnail
+        ))
+
+    return {
+        'id': playlist_data.get('id'),
+        'title': playlist_data.get('title'),
+        'description': playlist_data.get('description'),
+        'thumbnail_url': thumbnail_url,
+        'total': playlist_data.get('trackCount'),
+        'fetched_limit': limit,
+        'songs': songs
+    }
+
+def _fetch_made_for_you_playlist(playlist_id):
+    """
+    Lấy một playlist "Made for You" (chạy trong upstream_executor).
+    Cùng kết quả đó được ghi luôn vào cache của /api/playlist/<id>, thứ client mở ngay sau,
+    trừ khi cache đó đã lấy nhiều bài hơn (do phân trang): khi đó để refresh_playlist_details làm mới với đúng limit.
+    """
+    playlist_data = yt.get_playlist(playlistId=playlist_id, limit=PLAYLIST_PAGE_SIZE)
+    cache_key = _playlist_details_key(playlist_id)
+    try:
+        cached = _cached_data(cache_key)
+        if cached is None or (cached.get('fetched_limit') or PLAYLIST_PAGE_SIZE) <= PLAYLIST_PAGE_SIZE:
+            _store_json_cache(cache_key, _build_playlist_details(playlist_data, PLAYLIST_PAGE_SIZE))
+    except sqlite3.Error as e:
+        print(f"Lỗi khi ghi cache playlist {playlist_id}: {e}")
+
+    thumbnail_url = ""
+    if playlist_data.get('thumbnails'):
+        thumbnail_url = playlist_data['thumbnails'][-1]['url']
+
+    print(f"-> Lấy thành công thông tin playlist: {playlist_data.get('title')}")
+    return {
+        'id': playlist_data.get('id'),
+        'title': playlist_data.get('title'),
+        'description': playlist_data.get('description'),
+        'thumbnail_url': thumbnail_url,
+        'trackCount': playlist_data.get('trackCount')
+    }
+
+def _build_made_for_you():
+    """
+    Lấy song song các playlist "Made for You". Playlist nào lỗi hoặc quá hạn thì giữ bản trong cache cũ;
+    raise RuntimeError nếu không lấy mới được playlist nào (cache cũ giữ nguyên).
+    """
+    futures = [upstream_executor.submit(_fetch_made_for_you_playlist, playlist_id) for playlist_id in MADE_FOR_YOU_PLAYLISTS_IDS]
+    wait(futures, timeout=MADE_FOR_YOU_FETCH_TIMEOUT)
+
+    previous = _cached_data(MADE_FOR_YOU_KEY) or {}
+    previous_by_id = {playlist.get('id'): playlist for playlist in previous.get('playlists', [])}
+
+    playlists_details = []
+    fetched = 0
+    for playlist_id, future in zip(MADE_FOR_YOU_PLAYLISTS_IDS, futures):
+        if future.done() and future.exception() is None:
+            playlists_details.append(future.result())
+            fetched += 1
+            continue
+        error = future.exception() if future.done() else 'timeout'
+        print(f"Lỗi khi lấy playlist ID {playlist_id}: {error}")
+        if playlist_id in previous_by_id:
+            playlists_details.append(previous_by_id[playlist_id])
+
+    if not fetched:
+        raise RuntimeError("Không lấy được playlist 'Made for You' nào.")
+    return {'playlists': playlists_details}
+
+def _refresh_json_cache(key, build):
+    """
+    Dựng lại một mục cache và thay bản cũ (trong một transaction); build() lỗi thì bản cũ giữ nguyên.
+    Khóa theo key để hai worker không cùng dựng một cache.
+    """
+    with _file_lock(key):
+        return _store_json_cache(key, build())
+
 @app.route('/api/made_for_you', methods=['GET'])
 def get_made_for_you_playlists():
     """
     Lấy danh sách các playlist "Made for You", sử dụng cache.
+    Cache được refresh_scheduler làm mới trước khi hết hạn; request chỉ tự dựng khi chưa có cache.
     """
-    # 1. Kiểm tra file cache
-    if os.path.exists(CACHE_FILENAME_MADE_FOR_YOU):
-        last_modified_time = datetime.fromtimestamp(os.path.getmtime(CACHE_FILENAME_MADE_FOR_YOU))
-        if datetime.now() - last_modified_time < timedelta(hours=CACHE_DURATION_HOURS):
-            print("Đang trả về playlist 'Made for You' từ CACHE.")
-            try:
-                with open(CACHE_FILENAME_MADE_FOR_YOU, 'r', encoding='utf-8') as f:
-                    cached_data = json.load(f)
-                    return Response(json.dumps(cached_data, ensure_ascii=False), mimetype='application/json')
-            except (IOError, json.JSONDecodeError) as e:
-                print(f"Lỗi khi đọc file cache 'Made for You': {e}")
+    # 1. Kiểm tra cache (bộ nhớ trước, file sau)
+    entry = _load_json_cache_entry(MADE_FOR_YOU_KEY)
+    if entry is not None:
+        return _json_entry_response(entry)
 
-    # 2. Nếu cache không hợp lệ, lấy dữ liệu mới
+    # 2. Nếu chưa có cache, dựng mới (chỉ một request trong mọi worker gọi API)
     print("Cache 'Made for You' không hợp lệ. Đang lấy dữ liệu mới từ API...")
     try:
-        playlists_details = []
-        for playlist_id in MADE_FOR_YOU_PLAYLISTS_IDS:
-            try:
-                # Lấy thông tin chi tiết của từng playlist
-                playlist_data = yt.get_playlist(playlistId=playlist_id, limit=5) # chỉ cần limit=1 để lấy thông tin playlist
-                
-                thumbnail_url = ""
-                if playlist_data.get('thumbnails'):
-                    thumbnail_url = playlist_data['thumbnails'][-1]['url']
-                
-                playlists_details.append({
-                    'id': playlist_data.get('id'),
-                    'title': playlist_data.get('title'),
-                    'description': playlist_data.get('description'),
-                    'thumbnail_url': thumbnail_url,
-                    'trackCount': playlist_data.get('trackCount')
-                })
-                print(f"-> Lấy thành công thông tin playlist: {playlist_data.get('title')}")
-            except Exception as e:
-                print(f"Lỗi khi lấy playlist ID {playlist_id}: {e}")
-                continue # Bỏ qua playlist này nếu có lỗi
-
-        result = {'playlists': playlists_details}
-
-        # 3. Lưu dữ liệu mới vào file cache
-        try:
-            with open(CACHE_FILENAME_MADE_FOR_YOU, 'w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=4)
-            print(f"Saved new 'Made for You' cache to '{CACHE_FILENAME_MADE_FOR_YOU}'.")
-        except IOError as e:
-            print(f"Error writing to 'Made for You' cache file: {e}")
-
-        return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json')
+        entry = _get_or_fetch_json_entry(MADE_FOR_YOU_KEY, _build_made_for_you)
+        return _json_entry_response(entry)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f"An error occurred while fetching 'Made for You' playlists: {str(e)}"}), 500
+        return _json_response({'error': f"An error occurred while fetching 'Made for You' playlists: {str(e)}"}), 500
+
+def _playlist_details_complete(details):
+    """Cache đã chứa toàn bộ playlist chưa (cache cũ không có fetched_limit được lấy với limit=30)."""
+    songs = details.get('songs', [])
+    total = details.get('total')
+    if total is not None and len(songs) >= total:
+        return True
+    return len(songs) < (details.get('fetched_limit') or 30) or len(songs) >= PLAYLIST_MAX_TRACKS
+
+def _grow_playlist_details(playlist_id, needed):
+    """
+    Lấy thêm bài cho cache của playlist cho tới khi có ít nhất needed bài (hoặc hết playlist).
+    ytmusicapi không hỗ trợ offset nên mỗi lần lấy đều tải lại từ đầu playlist; limit được tăng gấp đôi
+    mỗi lần để số lần tải lại các trang đầu chỉ là log(số bài) thay vì một lần mỗi trang.
+    """
+    cache_key = _playlist_details_key(playlist_id)
+
+    def grow():
+        with _file_lock(cache_key):
+            # Worker khác có thể vừa lấy thêm trong lúc chờ khóa
+            details = _cached_data(cache_key)
+            if details is not None and (len(details.get('songs', [])) >= needed or _playlist_details_complete(details)):
+                return _load_json_cache_entry(cache_key) or JsonCacheEntry(details, time.time_ns())
+            current_limit = (details.get('fetched_limit') or 30) if details else PLAYLIST_PAGE_SIZE
+            limit = min(max(needed, current_limit * 2), PLAYLIST_MAX_TRACKS)
+            print(f"Lấy thêm bài cho playlist {playlist_id}: limit {current_limit} -> {limit}")
+            return _store_json_cache(cache_key, _fetch_playlist_details(playlist_id, limit))
+
+    return cache_fill_flight.do(cache_key, grow)
+
+# Các trang đã dựng của /api/playlist/<id>: (key cache, version, offset, limit) -> JsonCacheEntry
+playlist_page_cache = LRUCache(maxsize=JSON_MEMORY_CACHE_MAXSIZE)
+playlist_page_lock = threading.Lock()
+
+def _playlist_page_entry(playlist_id, offset, limit):
+    """JsonCacheEntry của một trang playlist, lấy thêm bài từ API nếu cache chưa đủ."""
+    cache_key = _playlist_details_key(playlist_id)
+    entry = _get_or_fetch_json_entry(cache_key, lambda: _fetch_playlist_details(playlist_id))
+    page_key = (cache_key, entry.updated_ns, offset, limit)
+    with playlist_page_lock:
+        page = playlist_page_cache.get(page_key)
+    if page is not None:
+        return page
+
+    details = entry.data
+    # Không lấy quá PLAYLIST_MAX_TRACKS hay quá số bài của playlist; offset vượt quá total là trang rỗng
+    needed = min(offset + limit, PLAYLIST_MAX_TRACKS)
+    total = details.get('total')
+    if total is not None:
+        needed = min(needed, total) if offset < total else 0
+    while len(details.get('songs', [])) < needed and not _playlist_details_complete(details):
+        entry = _grow_playlist_details(playlist_id, needed)
+        details = entry.data
+        page_key = (cache_key, entry.updated_ns, offset, limit)
+
+    songs = details.get('songs', [])
+    page_songs = songs[offset:offset + limit]
+    has_more = offset + limit < len(songs) or not _playlist_details_complete(details)
+    page = JsonCacheEntry({
+        'id': details.get('id'),
+        'title': details.get('title'),
+        'description': details.get('description'),
+        'thumbnail_url': details.get('thumbnail_url'),
+        'songs': page_songs,
+        'offset': offset,
+        'limit': limit,
+        'total': details.get('total'),
+        'next_offset': offset + len(page_songs) if has_more and page_songs else None
+    }, entry.updated_ns)
+    with playlist_page_lock:
+        playlist_page_cache[page_key] = page
+    return page
 
 @app.route('/api/playlist/<playlist_id>', methods=['GET'])
 def get_playlist_details(playlist_id):
     """
     Lấy thông tin chi tiết của một playlist, bao gồm danh sách bài hát.
-    Sử dụng cơ chế cache.
+    Hỗ trợ phân trang qua ?offset=&limit= (mặc định trang đầu PLAYLIST_PAGE_SIZE bài);
+    response có total và next_offset để client lấy trang kế tiếp.
+    Sử dụng cơ chế cache, mỗi playlist chỉ được lấy từ API một lần dù có nhiều request đồng thời.
     """
-    os.makedirs(PLAYLIST_DETAIL_CACHE_FOLDER, exist_ok=True)
-    cache_filepath = os.path.join(PLAYLIST_DETAIL_CACHE_FOLDER, f"{playlist_id}.json")
-
-    # 1. Kiểm tra cache
-    if os.path.exists(cache_filepath):
-        last_modified_time = datetime.fromtimestamp(os.path.getmtime(cache_filepath))
-        if datetime.now() - last_modified_time < timedelta(hours=CACHE_DURATION_HOURS):
-            print(f"Trả về chi tiết playlist '{playlist_id}' từ CACHE.")
-            try:
-                with open(cache_filepath, 'r', encoding='utf-8') as f:
-                    return Response(f.read(), mimetype='application/json')
-            except Exception as e:
-                print(f"Lỗi đọc file cache playlist: {e}")
-
-    print(f"Cache cho playlist '{playlist_id}' không hợp lệ. Lấy dữ liệu mới...")
     try:
-        # 2. Lấy dữ liệu từ API, không giới hạn số bài hát (hoặc mặc định 100)
-        playlist_data = yt.get_playlist(playlistId=playlist_id, limit = 30)
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', PLAYLIST_PAGE_SIZE))
+    except ValueError:
+        return _json_response({'error': 'offset và limit phải là số nguyên.'}), 400
+    if not 0 <= offset < PLAYLIST_MAX_TRACKS or not 0 < limit <= PLAYLIST_MAX_PAGE_SIZE:
+        return _json_response({
+            'error': f'offset phải trong khoảng 0..{PLAYLIST_MAX_TRACKS - 1} và limit trong khoảng 1..{PLAYLIST_MAX_PAGE_SIZE}.'
+        }), 400
 
-        # Trích xuất thông tin playlist
-        thumbnail_url = playlist_data.get('thumbnails', [])[-1]['url'] if playlist_data.get('thumbnails') else ""
-
-        # Trích xuất và định dạng lại danh sách bài hát
-        songs = []
-        for track in playlist_data.get('tracks', []):
-            artists = track.get("artists", [])
-            artist_names = ", ".join(artist.get("name", "Unknown") for artist in artists) if artists else "Unknown Artist"
-            track_thumbnail = track.get('thumbnails', [])[-1]['url'] if track.get('thumbnails') else ""
-            
-            songs.append({
-                "title": track.get("title", "Unknown Title"),
-                "artist": artist_names,
-                "duration": track.get("duration", "N/A"),
-                "video_id": track.get("videoId", ""),
-                "thumbnail_url": track_thumbnail
-            })
-
-        result = {
-            'id': playlist_data.get('id'),
-            'title': playlist_data.get('title'),
-            'description': playlist_data.get('description'),
-            'thumbnail_url': thumbnail_url,
-            'songs': songs
-        }
-
-        # 3. Lưu vào cache
-        with open(cache_filepath, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=4)
-        
-        return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json')
+    try:
+        entry = _playlist_page_entry(playlist_id, offset, limit)
+        # Client sẽ mở các bài đầu tiên ngay sau đó
+        stream_prefetcher.enqueue(entry.video_ids)
+        return _json_entry_response(entry)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f"Lỗi khi lấy chi tiết playlist: {str(e)}"}), 500
+        return _json_response({'error': f"Lỗi khi lấy chi tiết playlist: {str(e)}"}), 500
 
 
 # Hàm lấy thông tin nghệ sĩ từ Channel ID
 # trong file app.py
 # Hàm phụ để xử lý định dạng bài hát từ ytmusicapi
-def _parse_song_from_ytmusic(song_data, artist_name):
-    """Hàm này lấy dữ liệu thô từ ytmusicapi và chuyển thành định dạng JSON quen thuộc của chúng ta."""
+def _parse_song_from_ytmusic(song_data, artist_name, thumbnail_url=None):
+    """Hàm này lấy dữ liệu thô từ ytmusicapi và chuyển thành Song (serialize ra JSON quen thuộc ở biên)."""
     if not song_data:
         return None
     
     # Lấy thumbnail chất lượng cao nhất
-    thumbnail_url = None
-    if song_data.get('thumbnails'):
+    if thumbnail_url is None and song_data.get('thumbnails'):
         thumbnail_url = song_data['thumbnails'][-1]['url']
         
-    return {
-        'video_id': song_data.get("videoId", ""),
-        'title': song_data.get("title", "Unknown Title"),
-        'artist': ', '.join([artist['name'] for artist in song_data.get('artists', [])]) or artist_name,
-        'thumbnail_url': thumbnail_url,
-        'duration': song_data.get("duration", "N/A")
-    }
+    return Song.get(
+        song_data.get("videoId", ""),
+        song_data.get("title", "Unknown Title"),
+        ', '.join([artist['name'] for artist in song_data.get('artists', [])]) or artist_name,
+        song_data.get("duration", "N/A"),
+        thumbnail_url
+    )
 @app.route('/image-proxy')
 def image_proxy():
     """
@@ -300,260 +1823,1452 @@ def image_proxy():
     image_url = request.args.get('url')
 
     if not image_url:
-        return jsonify({'error': 'Missing image URL'}), 400
+        return _json_response({'error': 'Missing image URL'}), 400
+    try:
+        width = _requested_thumbnail_width()
+    except ValueError:
+        return _json_response({'error': 'w phải là số nguyên dương.'}), 400
+
+    # Thêm header User-Agent để giả dạng một trình duyệt thông thường
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+    }
+    if width is not None and Image is not None and _is_thumbnail_source_host(image_url):
+        def load_source():
+            return _download_thumbnail_source(image_url, headers)
+        try:
+            return _thumbnail_response(('url', image_url), load_source, width)
+        except Exception as e:
+            # Không thu nhỏ được thì relay ảnh gốc như bình thường
+            print(f"Lỗi khi tạo ảnh thu nhỏ cho {image_url}: {e}")
 
     try:
         # Gửi yêu cầu đến URL ảnh với stream=True để xử lý hiệu quả
-        # Thêm header User-Agent để giả dạng một trình duyệt thông thường
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(image_url, stream=True, headers=headers)
+        response = http_get(image_url, stream=True, headers=headers)
 
         # Kiểm tra xem yêu cầu có thành công không
         if response.status_code == 200:
             # Lấy content-type của ảnh gốc (ví dụ: 'image/jpeg')
             content_type = response.headers.get('content-type')
             # Trả về dữ liệu ảnh thô với đúng content-type
-            return Response(response.raw, content_type=content_type)
+            return Response(stream_stats.track(_relay_response(response), image_url, 'image'), content_type=content_type)
         else:
-            return jsonify({'error': 'Failed to fetch image'}), response.status_code
+            response.close()
+            return _json_response({'error': 'Failed to fetch image'}), response.status_code
 
     except Exception as e:
-        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+        return _json_response({'error': f'An error occurred: {str(e)}'}), 500
+
+def _fetch_artist_details(channel_id):
+    """Lấy thông tin nghệ sĩ và các bài hát hàng đầu từ API."""
+    ytmusic = YTMusic()
+    return _build_artist_details(ytmusic.get_artist(channelId=channel_id))
+
+def _artist_details_key(channel_id):
+    return f"artist:{channel_id}"
+
+def _build_artist_details(artist_data):
+    """Dựng dữ liệu cho /api/artist/<id> từ kết quả get_artist đã có sẵn."""
+    artist_name = artist_data.get('name')
+    artist_thumbnail = artist_data['thumbnails'][-1]['url'] if artist_data.get('thumbnails') else ""
+    description = artist_data.get('description')
+
+    songs = []
+    if artist_data.get('songs') and artist_data['songs'].get('results'):
+        top_songs_data = artist_data['songs']['results']
+        for song_item in top_songs_data:
+            original_song_thumbnail = song_item["thumbnails"][-1].get("url", "") if song_item.get("thumbnails") else ""
+
+            parsed_song = _parse_song_from_ytmusic(
+                song_item,
+                artist_name=artist_name,
+                thumbnail_url=resolve_thumbnail_url(original_song_thumbnail, song_item.get("videoId", ""))
+            )
+            if parsed_song:
+                songs.append(parsed_song)
+
+    return {
+        'artistName': artist_name,
+        'artistThumbnail': artist_thumbnail,
+        'description': description,
+        'songs': songs
+    }
 
 @app.route('/api/artist/<channel_id>', methods=['GET'])
 def get_artist_details(channel_id):
     """
     Lấy thông tin nghệ sĩ và các bài hát hàng đầu bằng ytmusicapi.
     SỬ DỤNG CƠ CHẾ CACHE ĐỂ TỐI ƯU HIỆU NĂNG.
+    Khi cache hết hạn, chỉ một request gọi API, các request đồng thời khác chờ kết quả đó.
     """
-    # Tạo đường dẫn file cache cho nghệ sĩ này
-    os.makedirs(ARTIST_DETAIL_CACHE_FOLDER, exist_ok=True)
-    cache_filepath = os.path.join(ARTIST_DETAIL_CACHE_FOLDER, f"{channel_id}.json")
-
-    # 1. Kiểm tra xem cache có hợp lệ không
-    if os.path.exists(cache_filepath):
-        last_modified_time = datetime.fromtimestamp(os.path.getmtime(cache_filepath))
-        # Sử dụng cùng CACHE_DURATION_HOURS
-        if datetime.now() - last_modified_time < timedelta(hours=CACHE_DURATION_HOURS):
-            print(f"Đang trả về chi tiết nghệ sĩ '{channel_id}' từ CACHE.")
-            try:
-                with open(cache_filepath, 'r', encoding='utf-8') as f:
-                    cached_data = json.load(f)
-                    return Response(json.dumps(cached_data, ensure_ascii=False), mimetype='application/json')
-            except (IOError, json.JSONDecodeError) as e:
-                print(f"Lỗi khi đọc file cache của nghệ sĩ, sẽ lấy dữ liệu mới. Lỗi: {e}")
-
-    # 2. Nếu cache không hợp lệ hoặc không tồn tại, lấy dữ liệu mới
-    print(f"Cache cho '{channel_id}' không hợp lệ. Đang lấy dữ liệu mới từ API...")
     try:
-        ytmusic = YTMusic()
-        artist_data = ytmusic.get_artist(channelId=channel_id)
-
-        artist_name = artist_data.get('name')
-        artist_thumbnail = artist_data['thumbnails'][-1]['url'] if artist_data.get('thumbnails') else ""
-        description = artist_data.get('description')
+        entry = _get_or_fetch_json_entry(_artist_details_key(channel_id), lambda: _fetch_artist_details(channel_id))
+        return _json_entry_response(entry)
 
-        songs = []
-        if artist_data.get('songs') and artist_data['songs'].get('results'):
-            top_songs_data = artist_data['songs']['results']
-            for song_item in top_songs_data:
-                original_song_thumbnail = song_item["thumbnails"][-1].get("url", "") if song_item.get("thumbnails") else ""
-                local_song_thumbnail_path = download_and_save_image(original_song_thumbnail, song_item.get("videoId", ""))
-
-                parsed_song = _parse_song_from_ytmusic(song_item, artist_name=artist_name)
-                if parsed_song:
-                    parsed_song['thumbnail_url'] = f"{baseUrl}{local_song_thumbnail_path}" if local_song_thumbnail_path else ""
-                    songs.append(parsed_song)
-
-        result = {
-            'artistName': artist_name,
-            'artistThumbnail': artist_thumbnail,
-            'description': description,
-            'songs': songs
-        }
-
-        # 3. Lưu kết quả mới vào file cache
-        try:
-            with open(cache_filepath, 'w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=4)
-            print(f"Đã lưu cache mới cho nghệ sĩ '{channel_id}' vào file.")
-        except IOError as e:
-            print(f"Lỗi khi ghi file cache cho nghệ sĩ: {e}")
+    except Exception as e:
+        return _json_response({'error': f"Đã có lỗi xảy ra khi lấy thông tin nghệ sĩ: {str(e)}"}), 500
 
-        return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json')
+def _thumbnail_filename(image_url, artist_name):
+    """Tên file cố định cho một ảnh: slug của tên + hash của URL (tránh trùng)."""
+    safe_name = "".join(c for c in (artist_name or "") if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    hash_code = hashlib.md5(image_url.encode()).hexdigest()[:8]
+    return f"{safe_name}_{hash_code}.jpg"
 
-    except Exception as e:
-        return jsonify({'error': f"Đã có lỗi xảy ra khi lấy thông tin nghệ sĩ: {str(e)}"}), 500
+def _image_looks_complete(filepath):
+    """
+    Kiểm tra rẻ cho ảnh không có trong bảng images (file cũ): JPEG phải kết thúc bằng EOI,
+    PNG bằng chunk IEND, WebP phải đủ kích thước ghi trong header RIFF.
+    """
+    try:
+        size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            head = f.read(12)
+            f.seek(max(size - 12, 0))
+            tail = f.read()
+    except OSError:
+        return False
+    if head.startswith(b'\xff\xd8'):
+        return tail.rstrip(b'\x00').endswith(b'\xff\xd9')
+    if head.startswith(b'\x89PNG'):
+        return tail.endswith(b'IEND\xaeB`\x82')
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 <= size
+    return size > 0
+
+
+class ImageStore:
+    """
+    Ảnh gốc đã tải trong ARTIST_IMAGE_FOLDER, chia vào thư mục con theo 2 ký tự hex đầu của md5(tên file)
+    để không có thư mục phẳng quá lớn. Bảng images trong metadata.db ghi kích thước và lần truy cập cuối:
+    một file chỉ được ghi kích thước sau khi đã tải đủ và đổi tên xong, nên lúc khởi động file nào
+    không có kích thước trong bảng (và không qua được _image_looks_complete) hoặc lệch kích thước là file dở và bị xóa.
+    Mỗi dòng giữ URL gốc của ảnh: client luôn nhận đường dẫn local, ảnh chưa có trên đĩa được tải lại từ đó.
+    Dung lượng được giới hạn bằng LRU theo last_access, dọn ở background.
+    """
 
-def download_and_save_image(image_url, artist_name):
+    def __init__(self, folder, max_bytes):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._touched = {} # path -> lần truy cập cuối, chưa ghi vào metadata.db
+        self._sources = {} # path -> (URL gốc, thời điểm) chưa ghi vào metadata.db
+        self._flush_scheduled = False
+        # path đã ghi source_url, khỏi ghi lại mỗi lần; hết hạn sớm hơn nhiều so với IMAGE_STORE_SOURCE_MAX_AGE
+        # để dòng bị evict bỏ đi sẽ được ghi lại
+        self._registered = TTLCache(maxsize=4096, ttl=86400)
+        self._last_flush = time.monotonic()
+        self._last_evict = 0
+        self._counters = {'stored': 0, 'evicted': 0, 'dropped': 0, 'migrated': 0}
+
+    @staticmethod
+    def relpath(filename):
+        """'<tên file>' -> '<shard>/<tên file>'."""
+        return f"{hashlib.md5(filename.encode()).hexdigest()[:2]}/{filename}"
+
+    def filepath(self, relpath):
+        return os.path.join(self._folder, relpath)
+
+    def touch(self, relpath):
+        """Ghi nhận một lần dùng ảnh; được gom lại và ghi vào metadata.db ở background."""
+        with self._lock:
+            self._touched[relpath] = time.time()
+            should_flush = time.monotonic() - self._last_flush >= IMAGE_STORE_TOUCH_FLUSH_INTERVAL
+            if should_flush:
+                self._last_flush = time.monotonic()
+        if should_flush:
+            background_executor.submit(self.flush)
+
+    def register(self, relpath, source_url):
+        """
+        Ghi nhận URL gốc của một ảnh chưa có trên đĩa, để route ảnh tải lại được khi client xin.
+        Không chờ metadata.db: được gom lại và ghi ở background ngay sau đó.
+        """
+        with self._lock:
+            if self._registered.get(relpath) == source_url or relpath in self._sources:
+                return
+            self._sources[relpath] = (source_url, time.time())
+            should_flush = not self._flush_scheduled
+            self._flush_scheduled = True
+        if should_flush:
+            background_executor.submit(self.flush)
+
+    def source_url(self, relpath):
+        with self._lock:
+            pending = self._sources.get(relpath)
+        if pending is not None:
+            return pending[0]
+        conn = _get_db()
+        row = conn.execute('SELECT source_url FROM images WHERE path = ?', (relpath,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, relpath, size, source_url):
+        """Ghi nhận một file vừa tải đủ (đã os.replace vào chỗ)."""
+        conn = _get_db()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO images (path, size, last_access, source_url) VALUES (?, ?, ?, ?)',
+                (relpath, size, time.time(), source_url)
+            )
+        with self._lock:
+            self._counters['stored'] += 1
+            should_evict = time.monotonic() - self._last_evict >= IMAGE_STORE_EVICT_INTERVAL
+            if should_evict:
+                self._last_evict = time.monotonic()
+        if should_evict:
+            background_executor.submit(self.evict)
+
+    def flush(self):
+        """Ghi các URL gốc và lần truy cập đang gom trong bộ nhớ vào metadata.db."""
+        with self._lock:
+            sources, self._sources = self._sources, {}
+            touched, self._touched = self._touched, {}
+            self._flush_scheduled = False
+        if not sources and not touched:
+            return
+        try:
+            conn = _get_db()
+            with conn:
+                conn.executemany(
+                    'INSERT INTO images (path, size, last_access, source_url) VALUES (?, NULL, ?, ?) '
+                    'ON CONFLICT (path) DO UPDATE SET source_url = excluded.source_url, '
+                    'last_access = MAX(last_access, excluded.last_access)',
+                    [(relpath, registered_at, source_url) for relpath, (source_url, registered_at) in sources.items()]
+                )
+                conn.executemany(
+                    'UPDATE images SET last_access = MAX(last_access, ?) WHERE path = ?',
+                    [(last_access, relpath) for relpath, last_access in touched.items()]
+                )
+        except sqlite3.Error as e:
+            print(f"Lỗi khi ghi URL gốc / lần truy cập ảnh: {e}")
+            return
+        with self._lock:
+            for relpath, (source_url, _) in sources.items():
+                self._registered[relpath] = source_url
+
+    def _remove(self, relpath):
+        """Xóa file nhưng giữ dòng (size NULL) nếu có URL gốc, vì JSON đã cache vẫn có thể trỏ tới ảnh này."""
+        try:
+            os.remove(self.filepath(relpath))
+        except FileNotFoundError:
+            pass
+        conn = _get_db()
+        with conn:
+            conn.execute('UPDATE images SET size = NULL WHERE path = ? AND source_url IS NOT NULL', (relpath,))
+            conn.execute('DELETE FROM images WHERE path = ? AND source_url IS NULL', (relpath,))
+
+    def evict(self):
+        """
+        Xóa các ảnh lâu không dùng nhất cho tới khi tổng dung lượng dưới giới hạn
+        (artist_image tải lại từ URL gốc nếu còn client xin), và bỏ các dòng chỉ còn URL gốc đã quá cũ.
+        """
+        self.flush()
+        conn = _get_db()
+        with conn:
+            conn.execute(
+                'DELETE FROM images WHERE size IS NULL AND last_access < ?',
+                (time.time() - IMAGE_STORE_SOURCE_MAX_AGE,)
+            )
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+        if total_bytes <= self._max_bytes:
+            return
+        victims = []
+        for relpath, size in conn.execute('SELECT path, size FROM images WHERE size IS NOT NULL ORDER BY last_access'):
+            if total_bytes <= self._max_bytes:
+                break
+            victims.append(relpath)
+            total_bytes -= size
+        for relpath in victims:
+            self._remove(relpath)
+        with self._lock:
+            self._counters['evicted'] += len(victims)
+        print(f"Đã xóa {len(victims)} ảnh ít dùng khỏi '{self._folder}'.")
+
+    def scan(self):
+        """
+        Lúc khởi động (một worker làm): chuyển file phẳng kiểu cũ vào shard, xóa file dở / file .part bỏ lại,
+        đánh dấu các dòng không còn file (bỏ hẳn nếu không có URL gốc), rồi dọn theo giới hạn dung lượng.
+        """
+        with _file_lock('image_store_scan', timeout=0) as locked:
+            if not locked or not os.path.isdir(self._folder):
+                return
+            conn = _get_db()
+            indexed = dict(conn.execute('SELECT path, size FROM images'))
+            seen = set()
+            dropped = migrated = 0
+            for root, _, filenames in os.walk(self._folder):
+                for filename in filenames:
+                    filepath = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(filepath)
+                    except FileNotFoundError:
+                        continue
+                    if filename.endswith('.part'):
+                        if time.time() - stat.st_mtime > IMAGE_STORE_PART_MAX_AGE:
+                            os.remove(filepath)
+                            dropped += 1
+                        continue
+
+                    relpath = os.path.relpath(filepath, self._folder).replace(os.sep, '/')
+                    size = indexed.get(relpath)
+                    if size == stat.st_size:
+                        seen.add(relpath)
+                        continue
+                    if size is not None or not _image_looks_complete(filepath):
+                        os.remove(filepath)
+                        dropped += 1
+                        continue
+                    if root == self._folder:
+                        # File phẳng từ trước khi có shard
+                        relpath = self.relpath(filename)
+                        os.makedirs(os.path.dirname(self.filepath(relpath)), exist_ok=True)
+                        os.replace(filepath, self.filepath(relpath))
+                        migrated += 1
+                    with conn:
+                        conn.execute(
+                            'INSERT INTO images (path, size, last_access) VALUES (?, ?, ?) '
+                            'ON CONFLICT (path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access',
+                            (relpath, stat.st_size, stat.st_mtime)
+                        )
+                    seen.add(relpath)
+
+            missing = [(relpath,) for relpath, size in indexed.items() if size is not None and relpath not in seen]
+            with conn:
+                conn.executemany('UPDATE images SET size = NULL WHERE path = ? AND source_url IS NOT NULL', missing)
+                conn.executemany('DELETE FROM images WHERE path = ? AND source_url IS NULL', missing)
+            with self._lock:
+                self._counters['dropped'] += dropped
+                self._counters['migrated'] += migrated
+            if dropped or migrated or missing:
+                print(f"Kiểm tra ảnh: chuyển {migrated} file vào shard, xóa {dropped} file dở, {len(missing)} dòng mất file.")
+        self.evict()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, pending_touches=len(self._touched), pending_sources=len(self._sources))
+
+image_store = ImageStore(ARTIST_IMAGE_FOLDER, IMAGE_STORE_MAX_BYTES)
+
+def download_and_save_image(image_url, relpath):
+    """Tải image_url vào image_store dưới relpath (xem _thumbnail_filename / ImageStore.relpath)."""
     if not image_url:
         return ""
 
     try:
-        # Tạo tên file từ artist name (slug + hash tránh trùng)
-        safe_name = "".join(c for c in artist_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        hash_code = hashlib.md5(image_url.encode()).hexdigest()[:8]
-        filename = f"{safe_name}_{hash_code}.jpg"
-        filepath = os.path.join(ARTIST_IMAGE_FOLDER, filename)
+        filepath = image_store.filepath(relpath)
 
         # Nếu file đã tồn tại, không tải lại
         if os.path.exists(filepath):
-            return f"/static/artists/{filename}"
+            return f"/static/artists/{relpath}"
 
-        # Tải ảnh
-        response = requests.get(image_url, stream=True, timeout=5)
+        # Tải ảnh; xin body không nén để Content-Length khớp với số byte ghi ra file
+        response = http_get(image_url, stream=True, timeout=5, headers={'Accept-Encoding': 'identity'})
         if response.status_code == 200:
-            os.makedirs(ARTIST_IMAGE_FOLDER, exist_ok=True)
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
-            print(f"Tải ảnh thành công: {filename}")
-            return f"/static/artists/{filename}"
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            expected_size = 0
+            if response.headers.get('Content-Encoding', 'identity') == 'identity':
+                # Server vẫn nén thì Content-Length là số byte đã nén, không dùng để kiểm tra được
+                expected_size = int(response.headers.get('Content-Length') or 0)
+            # Ghi ra file tạm rồi đổi tên, để không bao giờ có file ảnh dở dang
+            temp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.part"
+            size = 0
+            try:
+                with open(temp_filepath, 'wb') as f:
+                    try:
+                        for chunk in _iter_response_chunks(response):
+                            f.write(chunk)
+                            size += len(chunk)
+                    finally:
+                        response.close()
+                if expected_size and size != expected_size:
+                    raise IOError(f"tải được {size}/{expected_size} bytes")
+                os.replace(temp_filepath, filepath)
+            except BaseException:
+                if os.path.exists(temp_filepath):
+                    os.remove(temp_filepath)
+                raise
+            image_store.add(relpath, size, image_url)
+            print(f"Tải ảnh thành công: {relpath}")
+            return f"/static/artists/{relpath}"
         else:
+            response.close()
             print(f"Lỗi khi tải ảnh ({image_url}): {response.status_code}")
             return ""
     except Exception as e:
-        print(f"Lỗi khi lưu ảnh cho {artist_name}: {e}")
+        print(f"Lỗi khi lưu ảnh {relpath}: {e}")
         return ""
 
+
+class ThumbnailPrefetcher:
+    """
+    Tải thumbnail ở background bằng một pool có giới hạn.
+    Mỗi file chỉ được tải một lần tại một thời điểm, có retry với backoff.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='thumbnail')
+        self._max_queue = max_queue
+        self._lock = threading.Lock()
+        self._inflight = set() # relpath đang chờ hoặc đang tải
+        self._counters = {
+            'enqueued': 0,
+            'deduplicated': 0,
+            'dropped': 0,
+            'downloaded': 0,
+            'failed': 0,
+            'retries': 0
+        }
+
+    def enqueue(self, image_url, relpath):
+        with self._lock:
+            if relpath in self._inflight:
+                self._counters['deduplicated'] += 1
+                return
+            if len(self._inflight) >= self._max_queue:
+                self._counters['dropped'] += 1
+                return
+            self._inflight.add(relpath)
+            self._counters['enqueued'] += 1
+        self._executor.submit(self._download, image_url, relpath)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, queue_depth=len(self._inflight))
+
+    def _download(self, image_url, relpath):
+        try:
+            for attempt in range(THUMBNAIL_MAX_RETRIES + 1):
+                if attempt:
+                    self._count('retries')
+                    time.sleep(THUMBNAIL_RETRY_BACKOFF * 2 ** (attempt - 1))
+                if download_and_save_image(image_url, relpath):
+                    self._count('downloaded')
+                    return
+            self._count('failed')
+        finally:
+            with self._lock:
+                self._inflight.discard(relpath)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+thumbnail_prefetcher = ThumbnailPrefetcher(max_workers=THUMBNAIL_WORKERS, max_queue=THUMBNAIL_QUEUE_MAX)
+
+def resolve_thumbnail_url(image_url, artist_name):
+    """
+    Trả về URL thumbnail cho client ngay lập tức, không chờ tải ảnh.
+    Luôn là đường dẫn local cố định /static/artists/<shard>/<name>_<hash>.jpg (nên ghi được vào cache lâu dài);
+    nếu ảnh chưa có trên đĩa thì ghi lại URL gốc và xếp hàng tải ở background,
+    client xin trước khi tải xong sẽ được artist_image chuyển hướng sang URL gốc.
+    """
+    if not image_url:
+        return ""
+
+    relpath = image_store.relpath(_thumbnail_filename(image_url, artist_name))
+    if os.path.exists(image_store.filepath(relpath)):
+        image_store.touch(relpath)
+    else:
+        image_store.register(relpath, image_url)
+        thumbnail_prefetcher.enqueue(image_url, relpath)
+    return f"{baseUrl}/static/artists/{relpath}"
+
+
+class ImageDerivativeCache:
+    """
+    Ảnh thu nhỏ (theo THUMBNAIL_WIDTHS, WebP hoặc JPEG) được tạo ở lần đầu có client xin rồi lưu trên đĩa.
+    Key theo nội dung: sha1 của ảnh gốc + cỡ + định dạng, nên một ảnh dưới nhiều URL / tên file chỉ có một bản.
+    Mỗi lần dùng ghi lại atime của file; dung lượng được giới hạn bằng LRU theo atime.
+    """
+    FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+
+    def __init__(self, folder, max_bytes):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._render_locks = [threading.Lock() for _ in range(CACHE_LOCK_STRIPES)]
+        self._digests = LRUCache(maxsize=4096) # nguồn (file + phiên bản, hoặc URL) -> sha1 ảnh gốc
+        self._last_evict = 0
+        self._counters = {'hits': 0, 'rendered': 0, 'evicted': 0}
+
+    def _path(self, digest, width, fmt):
+        return os.path.join(self._folder, digest[:2], f"{digest}_{width}.{fmt}")
+
+    def get(self, source_key, load_source, width, fmt):
+        """
+        Đường dẫn file ảnh thu nhỏ của nguồn source_key. load_source() trả bytes ảnh gốc,
+        chỉ được gọi khi chưa biết hash của nguồn hoặc phải tạo ảnh mới.
+        """
+        source = None
+        with self._lock:
+            digest = self._digests.get(source_key)
+        if digest is None:
+            source = load_source()
+            digest = hashlib.sha1(source).hexdigest()
+            with self._lock:
+                self._digests[source_key] = digest
+
+        path = self._path(digest, width, fmt)
+        if self._touch(path):
+            self._count('hits')
+            return path
+        with self._render_locks[hash(path) % len(self._render_locks)]:
+            if self._touch(path):
+                self._count('hits')
+                return path
+            self._render(source if source is not None else load_source(), path, width, fmt)
+        self._count('rendered')
+        self._maybe_evict()
+        return path
+
+    @staticmethod
+    def _touch(path):
+        """Cập nhật atime (giữ mtime để ETag không đổi); False nếu file chưa có."""
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _render(self, source, path, width, fmt):
+        pillow_format, _ = self.FORMATS[fmt]
+        with Image.open(io.BytesIO(source)) as image:
+            # Kích thước đọc từ header, chưa giải mã: từ chối ảnh quá nhiều điểm ảnh
+            if image.width * image.height > THUMBNAIL_MAX_PIXELS:
+                raise ValueError(f"Ảnh {image.width}x{image.height} quá lớn để thu nhỏ")
+            # JPEG được giải mã thẳng ở độ phân giải nhỏ hơn, nhanh hơn nhiều so với giải mã đủ cỡ
+            image.draft('RGB', (width, width))
+            image.thumbnail((width, image.height)) # chỉ giới hạn chiều rộng, không phóng to
+            if pillow_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            elif pillow_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            output = io.BytesIO()
+            if pillow_format == 'JPEG':
+                image.save(output, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY, optimize=True, progressive=True)
+            else:
+                image.save(output, 'WEBP', quality=THUMBNAIL_WEBP_QUALITY, method=4)
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(output.getvalue())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _maybe_evict(self):
+        with self._lock:
+            should_evict = time.monotonic() - self._last_evict >= THUMBNAIL_DERIVATIVE_EVICT_INTERVAL
+            if should_evict:
+                self._last_evict = time.monotonic()
+        if should_evict:
+            background_executor.submit(self.evict)
+
+    def evict(self):
+        """Xóa các ảnh thu nhỏ lâu không dùng nhất cho tới khi tổng dung lượng dưới giới hạn."""
+        entries = []
+        total_bytes = 0
+        for root, _, filenames in os.walk(self._folder):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                total_bytes += stat.st_size
+                entries.append((stat.st_atime, path, stat.st_size))
+
+        entries.sort()
+        for _, path, size in entries:
+            if total_bytes <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            self._count('evicted')
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+image_derivatives = ImageDerivativeCache(THUMBNAIL_DERIVATIVE_FOLDER, THUMBNAIL_DERIVATIVE_MAX_BYTES)
+if Image is not None:
+    # Pillow báo DecompressionBombError với ảnh lớn gấp đôi ngưỡng này ngay cả ngoài _render
+    Image.MAX_IMAGE_PIXELS = THUMBNAIL_MAX_PIXELS
+
+def _is_thumbnail_source_host(image_url):
+    """URL ảnh có thuộc THUMBNAIL_SOURCE_HOSTS không (chỉ các ảnh đó mới được tải về để thu nhỏ)."""
+    try:
+        host = (urlsplit(image_url).hostname or '').lower()
+    except ValueError:
+        return False
+    return any(host == allowed or host.endswith('.' + allowed) for allowed in THUMBNAIL_SOURCE_HOSTS)
+
+def _download_thumbnail_source(image_url, headers):
+    """Tải ảnh gốc để thu nhỏ, dừng ngay khi vượt THUMBNAIL_SOURCE_MAX_BYTES."""
+    response = http_get(image_url, headers=headers, stream=True, timeout=THUMBNAIL_SOURCE_TIMEOUT)
+    try:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length') or 0) > THUMBNAIL_SOURCE_MAX_BYTES:
+            raise ValueError(f"Ảnh gốc lớn hơn {THUMBNAIL_SOURCE_MAX_BYTES} bytes")
+        source = bytearray()
+        for chunk in _iter_response_chunks(response):
+            source += chunk
+            if len(source) > THUMBNAIL_SOURCE_MAX_BYTES:
+                raise ValueError(f"Ảnh gốc lớn hơn {THUMBNAIL_SOURCE_MAX_BYTES} bytes")
+        return bytes(source)
+    finally:
+        response.close()
+
+def _requested_thumbnail_width():
+    """
+    Cỡ ảnh theo ?w=, làm tròn lên cỡ gần nhất trong THUMBNAIL_WIDTHS (tối đa cỡ lớn nhất).
+    None nếu không có ?w=, ValueError nếu giá trị không hợp lệ.
+    """
+    value = request.args.get('w')
+    if value is None:
+        return None
+    width = int(value)
+    if width <= 0:
+        raise ValueError(value)
+    return next((size for size in THUMBNAIL_WIDTHS if size >= width), THUMBNAIL_WIDTHS[-1])
+
+def _thumbnail_response(source_key, load_source, width):
+    """Gửi ảnh thu nhỏ: WebP nếu client ghi rõ hỗ trợ trong Accept, ngược lại JPEG."""
+    fmt = 'webp' if any(mimetype == 'image/webp' and quality for mimetype, quality in request.accept_mimetypes) else 'jpeg'
+    path = image_derivatives.get(source_key, load_source, width, fmt)
+    response = send_file(os.path.abspath(path), mimetype=ImageDerivativeCache.FORMATS[fmt][1], max_age=IMAGE_CLIENT_MAX_AGE)
+    response.vary.add('Accept')
+    return response
+
+@app.route('/static/artists/<path:filename>')
+def artist_image(filename):
+    """
+    Ảnh đã tải về trong image_store; ?w= trả bản thu nhỏ (cần Pillow, không có thì trả ảnh gốc).
+    URL phẳng kiểu cũ (/static/artists/<tên file>, còn trong các cache cũ) được chuyển sang shard.
+    Ảnh chưa có trên đĩa nhưng biết URL gốc: xếp hàng tải và chuyển hướng (302) sang URL gốc.
+    """
+    folder = os.path.abspath(ARTIST_IMAGE_FOLDER)
+    try:
+        width = _requested_thumbnail_width()
+    except ValueError:
+        return _json_response({'error': 'w phải là số nguyên dương.'}), 400
+
+    if '/' not in filename:
+        filename = image_store.relpath(filename)
+    filepath = safe_join(folder, filename)
+    if filepath is None:
+        abort(404)
+    if not os.path.isfile(filepath):
+        source_url = image_store.source_url(filename)
+        if not source_url:
+            abort(404)
+        image_store.touch(filename)
+        thumbnail_prefetcher.enqueue(source_url, filename)
+        return redirect(source_url)
+    image_store.touch(filename)
+    if width is not None and Image is not None:
+        stat = os.stat(filepath)
+        def load_source():
+            with open(filepath, 'rb') as f:
+                return f.read()
+        try:
+            return _thumbnail_response((filepath, stat.st_mtime_ns, stat.st_size), load_source, width)
+        except Exception as e:
+            print(f"Lỗi khi tạo ảnh thu nhỏ cho {filename}: {e}")
+    return send_from_directory(folder, filename)
+
        
+def _fetch_popular_artist(artist_id):
+    """
+    Lấy một nghệ sĩ cho danh sách nổi bật (chạy trong upstream_executor).
+    Kết quả get_artist được dùng lại để ghi luôn cache của /api/artist/<id>.
+    """
+    artist_data = yt.get_artist(channelId=artist_id)
+    try:
+        _store_json_cache(_artist_details_key(artist_id), _build_artist_details(artist_data))
+    except sqlite3.Error as e:
+        print(f"Error writing artist details cache for {artist_id}: {e}")
+
+    thumbnail_url = ""
+    if artist_data.get('thumbnails'):
+        thumbnail_url = resolve_thumbnail_url(artist_data['thumbnails'][-1]['url'], artist_data.get('name'))
+
+    print(f"-> Successfully fetched details for artist: {artist_data.get('name')}")
+    return {
+        'artistName': artist_data.get('name'),
+        'channelId': artist_id,
+        'thumbnailUrl': thumbnail_url
+    }
+
+def _collect_popular_artists(artist_ids, futures):
+    """
+    Các nghệ sĩ đã lấy xong, giữ đúng thứ tự trong playlist, và số nghệ sĩ lấy mới được.
+    Nghệ sĩ bị lỗi hoặc chưa xong thì dùng bản trong cache cũ (nếu có).
+    """
+    previous = _cached_data(POPULAR_ARTISTS_KEY) or {}
+    previous_by_id = {artist.get('channelId'): artist for artist in previous.get('artists', [])}
+
+    popular_artists = []
+    fetched = 0
+    for artist_id, future in zip(artist_ids, futures):
+        if future.done() and future.exception() is None:
+            popular_artists.append(future.result())
+            fetched += 1
+            continue
+        if future.done():
+            print(f"Could not fetch full details for artist ID {artist_id}. Skipping. Error: {future.exception()}")
+        if artist_id in previous_by_id:
+            popular_artists.append(previous_by_id[artist_id])
+    return popular_artists, fetched
+
+def _finish_popular_artists(artist_ids, futures, returned_count):
+    """Chờ các nghệ sĩ còn lại ở background rồi ghi lại cache với danh sách đầy đủ hơn."""
+    wait(futures, timeout=POPULAR_ARTISTS_BACKGROUND_TIMEOUT)
+    popular_artists, fetched = _collect_popular_artists(artist_ids, futures)
+    if fetched <= returned_count:
+        return
+    try:
+        _store_json_cache(POPULAR_ARTISTS_KEY, {'artists': popular_artists})
+        print(f"Updated popular artists cache with {len(popular_artists)} artists.")
+    except sqlite3.Error as e:
+        print(f"Error writing to cache file: {e}")
+
+def _build_popular_artists(deadline=POPULAR_ARTISTS_DEADLINE):
+    """
+    Dựng danh sách nghệ sĩ nổi bật, lấy chi tiết các nghệ sĩ song song và chỉ chờ tối đa deadline giây.
+    Nghệ sĩ chưa xong được chờ tiếp ở background rồi ghi lại cache; nghệ sĩ lỗi / chưa xong giữ bản cũ.
+    Raise RuntimeError nếu không lấy mới được nghệ sĩ nào (cache cũ giữ nguyên).
+    """
+    playlist_id = 'PLXl9q53Jut6nT4VBv_fbd-HLiYmTkih8_'
+    playlist_data = yt.get_playlist(playlist_id, limit=50)
+    tracks = playlist_data.get('tracks', [])
+    
+    unique_artist_ids = []
+    seen_artist_ids = set()
+    for track in tracks:
+        if track and 'artists' in track:
+            for artist_data in track['artists']:
+                channel_id = artist_data.get('id')
+                if channel_id and channel_id not in seen_artist_ids:
+                    seen_artist_ids.add(channel_id)
+                    unique_artist_ids.append(channel_id)
+                    if len(unique_artist_ids) >= POPULAR_ARTISTS_LIMIT:
+                        break
+        if len(unique_artist_ids) >= POPULAR_ARTISTS_LIMIT:
+            break
+    
+    print(f"Found {len(unique_artist_ids)} unique artists. Fetching full details...")
+
+    futures = [upstream_executor.submit(_fetch_popular_artist, artist_id) for artist_id in unique_artist_ids]
+    _, pending = wait(futures, timeout=deadline)
+    popular_artists, fetched = _collect_popular_artists(unique_artist_ids, futures)
+    if pending:
+        print(f"{len(pending)} artists still loading after {deadline}s. Finishing in background.")
+        background_executor.submit(_finish_popular_artists, unique_artist_ids, futures, fetched)
+
+    if not fetched:
+        raise RuntimeError("Không lấy được nghệ sĩ nổi bật nào.")
+    return {'artists': popular_artists}
+
 @app.route('/api/popular_artists', methods=['GET'])
 def get_popular_artists():
     """
     Lấy danh sách nghệ sĩ nổi bật, sử dụng cơ chế cache để tối ưu hiệu năng.
+    Cache được refresh_scheduler làm mới ở background; request chỉ tự dựng khi chưa có cache.
     """
     if not yt:
-        return jsonify({'error': 'YTMusic service is not available.'}), 503
+        return _json_response({'error': 'YTMusic service is not available.'}), 503
 
-    cache_is_valid = False
-    
-    # 1. Kiểm tra file cache có tồn tại và còn mới không
-    if os.path.exists(CACHE_FILENAME_ARTISTS):
-        last_modified_time = datetime.fromtimestamp(os.path.getmtime(CACHE_FILENAME_ARTISTS))
-        if datetime.now() - last_modified_time < timedelta(hours=CACHE_DURATION_HOURS):
-            cache_is_valid = True
-            
-    # 2. Nếu cache hợp lệ, đọc dữ liệu từ file và trả về
-    if cache_is_valid:
-        print("Đang trả về dữ liệu từ CACHE...")
-        try:
-            with open(CACHE_FILENAME_ARTISTS, 'r', encoding='utf-8') as f:
-                cached_data = json.load(f)
-                return Response(json.dumps(cached_data, ensure_ascii=False), mimetype='application/json')
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"Lỗi khi đọc file cache, sẽ lấy dữ liệu mới. Lỗi: {e}")
-
-    # 3. Nếu không có cache hoặc cache đã cũ, tiến hành gọi API mới
-    print("Cache không hợp lệ hoặc không tồn tại. Đang lấy dữ liệu mới từ API...")
-    try:
-        playlist_id = 'PLXl9q53Jut6nT4VBv_fbd-HLiYmTkih8_'
-        playlist_data = yt.get_playlist(playlist_id, limit=50)
-        tracks = playlist_data.get('tracks', [])
-        
-        unique_artist_ids = []
-        seen_artist_ids = set()
-        for track in tracks:
-            if track and 'artists' in track:
-                for artist_data in track['artists']:
-                    channel_id = artist_data.get('id')
-                    if channel_id and channel_id not in seen_artist_ids:
-                        seen_artist_ids.add(channel_id)
-                        unique_artist_ids.append(channel_id)
-                        if len(unique_artist_ids) >= 10:
-                            break
-            if len(unique_artist_ids) >= 10:
-                break
-        
-        print(f"Found {len(unique_artist_ids)} unique artists. Fetching full details...")
+    try:
+        entry = _get_or_fetch_json_entry(POPULAR_ARTISTS_KEY, _build_popular_artists)
+        return _json_entry_response(entry)
 
-        # Lấy thông tin chi tiết cho từng nghệ sĩ
-        popular_artists = []
-        for artist_id in unique_artist_ids:
-            try:
-                artist_details = yt.get_artist(channelId=artist_id)
-                
-                thumbnail_url = ""
-                if artist_details.get('thumbnails'):
-                    original_url = artist_details['thumbnails'][-1]['url']
-                    thumbnail_url = download_and_save_image(original_url, artist_details.get('name'))
-                    print(f"DEBUGGING URL: Artist: {artist_details.get('name')} -- URL: {thumbnail_url}")
-                    
-                popular_artists.append({
-                    'artistName': artist_details.get('name'),
-                    'channelId': artist_id,
-                    'thumbnailUrl': baseUrl +'/' + thumbnail_url
-                })
-                print(f"-> Successfully fetched details for artist: {artist_details.get('name')}")
-            except Exception as artist_e:
-                print(f"Could not fetch full details for artist ID {artist_id}. Skipping. Error: {artist_e}")
-                continue # Bỏ qua nghệ sĩ này nếu có lỗi
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return _json_response({'error': f"An error occurred while fetching the artist list: {str(e)}"}), 500
 
-        result = {'artists': popular_artists}
+# Sử dụng yt-dlp để lấy URL stream của video YouTube
+YTDLP_OPTIONS = {
+    'format': 'bestaudio[ext=m4a]/bestaudio/best',
+    'extractor_args': {
+    'youtube': ['player_client=web']
+    },
+    'quiet': True,
+    'noplaylist': True,
+    'forceurl': True,
+    'forcejson': True,
+    'skip_download': True,
+    'cachedir': YTDLP_CACHE_DIR,
+    'socket_timeout': 10
+}
+
+
+class YoutubeDLPool:
+    """
+    Pool các instance yt_dlp.YoutubeDL được tạo sẵn và dùng lại, thay vì tạo mới cho mỗi lần resolve.
+    Các instance dùng chung cache chữ ký player (trong bộ nhớ và trên đĩa qua cachedir).
+    Mỗi instance chỉ được một luồng dùng tại một thời điểm; hết instance rảnh thì chờ tối đa timeout.
+    """
 
-        # 4. Lưu dữ liệu mới vào file cache để dùng cho lần sau
+    def __init__(self, size, options):
+        self._size = size
+        self._options = options
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._player_cache = {}
+        self._code_cache = {}
+        self._latencies = deque(maxlen=200)
+        self._counters = {'resolves': 0, 'failures': 0, 'checkout_timeouts': 0, 'in_use': 0, 'waiting': 0}
+
+    def _create(self):
+        ydl = yt_dlp.YoutubeDL(self._options)
+        # Khởi tạo sẵn extractor YouTube và cho nó dùng chung cache player JS / chữ ký
+        extractor = ydl.get_info_extractor('Youtube')
+        if hasattr(extractor, '_player_cache'):
+            extractor._player_cache = self._player_cache
+        if hasattr(extractor, '_code_cache'):
+            extractor._code_cache = self._code_cache
+        return ydl
+
+    def _reserve_slot(self):
+        with self._lock:
+            if self._created >= self._size:
+                return False
+            self._created += 1
+            return True
+
+    def warm(self):
+        """Tạo trước tất cả instance (gọi ở background lúc khởi động)."""
+        while self._reserve_slot():
+            try:
+                self._idle.put(self._create())
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        print(f"Đã khởi tạo sẵn {self._size} instance YoutubeDL.")
+
+    @contextmanager
+    def checkout(self, timeout=YTDLP_CHECKOUT_TIMEOUT):
+        """Mượn một instance; raise TimeoutError nếu pool bận quá timeout giây."""
         try:
-            with open(CACHE_FILENAME_ARTISTS, 'w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=4)
-            print(f"Saved new artist cache to '{CACHE_FILENAME_ARTISTS}'.")
-        except IOError as e:
-            print(f"Error writing to cache file: {e}")
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            if self._reserve_slot():
+                try:
+                    ydl = self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                self._count('waiting', 1)
+                try:
+                    ydl = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    self._count('checkout_timeouts', 1)
+                    raise TimeoutError(f"YoutubeDL pool busy for more than {timeout}s")
+                finally:
+                    self._count('waiting', -1)
+
+        self._count('in_use', 1)
+        try:
+            yield ydl
+        finally:
+            self._count('in_use', -1)
+            self._idle.put(ydl)
+
+    def extract_info(self, url):
+        with self.checkout() as ydl:
+            started_at = time.monotonic()
+            try:
+                return ydl.extract_info(url, download=False)
+            except Exception:
+                self._count('failures', 1)
+                raise
+            finally:
+                with self._lock:
+                    self._counters['resolves'] += 1
+                    self._latencies.append(time.monotonic() - started_at)
+
+    def available(self):
+        """Số resolve có thể bắt đầu ngay mà không phải chờ."""
+        with self._lock:
+            return self._idle.qsize() + (self._size - self._created)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+            created = self._created
+        percentile = lambda p: round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 3) if latencies else None
+        return dict(
+            counters,
+            size=self._size,
+            created=created,
+            idle=self._idle.qsize(),
+            saturation=round(counters['in_use'] / self._size, 2),
+            latency_avg=round(sum(latencies) / len(latencies), 3) if latencies else None,
+            latency_p50=percentile(0.5),
+            latency_p95=percentile(0.95)
+        )
+
+    def _count(self, name, delta):
+        with self._lock:
+            self._counters[name] += delta
 
-        return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json')
+ytdl_pool = YoutubeDLPool(YTDLP_POOL_SIZE, YTDLP_OPTIONS)
 
+def _extract_streaming_url(video_id):
+    """
+    Resolve URL stream bằng một instance trong ytdl_pool.
+    Lỗi của yt-dlp trả về (None, None); pool quá tải thì raise TimeoutError (không bị cache).
+    """
+    logging.info(f"Fetching stream URL for {video_id}")
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    try:
+        info = ytdl_pool.extract_info(url)
+        return info.get('url'), info.get('ext')  
+    except TimeoutError:
+        raise
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f"An error occurred while fetching the artist list: {str(e)}"}), 500
+        logging.error(f"yt-dlp failed: {e}")
+        return None, None
+
+STREAM_URL_EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+STREAM_URL_ITAG_PATTERN = re.compile(r'[?&/]itag[=/](\d+)')
+
+def _stream_url_expires_at(stream_url):
+    """Thời điểm (epoch) URL googlevideo hết hạn, đọc từ tham số expire=, hoặc None."""
+    match = STREAM_URL_EXPIRE_PATTERN.search(stream_url or '')
+    return int(match.group(1)) if match else None
+
+def _audio_cache_key(video_id, stream_url, ext):
+    """
+    Key audio cache theo định dạng thật (itag= của URL googlevideo), không chỉ theo đuôi file:
+    cùng là m4a nhưng itag 140 và 139 là hai bản mã hóa khác nhau, byte không ghép được với nhau.
+    """
+    match = STREAM_URL_ITAG_PATTERN.search(stream_url or '')
+    key = f"{video_id}.{ext or 'audio'}"
+    return f"{key}.{match.group(1)}" if match else key
+
+
+class StreamUrlCache:
+    """
+    Cache URL stream theo video_id, hết hạn theo expire= thật của URL (trừ một khoảng an toàn)
+    thay vì một TTL cố định. Lỗi resolve chỉ được nhớ trong thời gian ngắn.
+    URL đang được nghe nhiều sẽ được resolve lại ở background trước khi hết hạn.
+    """
+
+    def __init__(self, maxsize, resolve):
+        self._entries = LRUCache(maxsize=maxsize)
+        self._resolve = resolve
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._refreshing = set()
+
+    def get(self, video_id):
+        """Trả (url, ext) cho video_id, (None, None) nếu không resolve được."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None and entry['valid_until'] > now:
+                entry['hits'] += 1
+                if (entry['url'] and entry['hits'] >= STREAM_URL_HOT_HITS
+                        and entry['valid_until'] - now < STREAM_URL_REFRESH_AHEAD
+                        and video_id not in self._refreshing):
+                    self._refreshing.add(video_id)
+                    background_executor.submit(self._refresh, video_id)
+                return entry['url'], entry['ext']
+        return self._flight.do(video_id, lambda: self._load(video_id))
+
+    def put(self, video_id, stream_url, ext, hits=0):
+        if stream_url:
+            expires_at = _stream_url_expires_at(stream_url) or time.time() + STREAM_URL_DEFAULT_TTL
+            valid_until = expires_at - STREAM_URL_EXPIRY_MARGIN
+        else:
+            valid_until = time.time() + STREAM_URL_NEGATIVE_TTL
+        with self._lock:
+            self._entries[video_id] = {'url': stream_url, 'ext': ext, 'valid_until': valid_until, 'hits': hits}
+
+    def invalidate(self, video_id):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def __contains__(self, video_id):
+        with self._lock:
+            entry = self._entries.get(video_id)
+            return entry is not None and entry['valid_until'] > time.time()
+
+    def _load(self, video_id, hits=0):
+        stream_url, ext = self._resolve(video_id)
+        self.put(video_id, stream_url, ext, hits)
+        return stream_url, ext
+
+    def _refresh(self, video_id):
+        try:
+            with self._lock:
+                entry = self._entries.get(video_id)
+                hits = entry['hits'] if entry else 0
+            stream_url, ext = self._resolve(video_id)
+            # Chỉ thay URL cũ khi resolve lại thành công
+            if stream_url:
+                self.put(video_id, stream_url, ext, hits)
+        finally:
+            with self._lock:
+                self._refreshing.discard(video_id)
+
+stream_cache = StreamUrlCache(STREAM_CACHE_MAXSIZE, _extract_streaming_url)
 
 # Hàm này sẽ được gọi khi người dùng yêu cầu tải một bài hát cụ thể
 @app.route('/download/<string:video_id>')
 
-# Sử dụng yt-dlp để lấy URL stream của video YouTube
 # Hàm này sẽ được gọi khi người dùng yêu cầu stream một bài hát cụ thể
-@cached(stream_cache)
 def get_streaming_url(video_id):
-    logging.info(f"Fetching stream URL for {video_id}")
-    url = f"https://www.youtube.com/watch?v={video_id}"
-    ydl_opts = {
-        'format': 'bestaudio[ext=m4a]/bestaudio/best',
-        'extractor_args': {
-        'youtube': ['player_client=web']
-        },
-        'quiet': True,
-        'noplaylist': True,
-        'forceurl': True,
-        'forcejson': True,
-        'skip_download': True
-    }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return info.get('url'), info.get('ext')  
-    except Exception as e:
-        logging.error(f"yt-dlp failed: {e}")
+        return stream_cache.get(video_id)
+    except TimeoutError as e:
+        logging.error(f"Could not resolve stream URL for {video_id}: {e}")
+        return None, None
+
+def _reresolve_streaming_url(video_id):
+    """Bỏ URL đang cache (upstream trả 403/410) và resolve lại."""
+    stream_cache.invalidate(video_id)
+    return get_streaming_url(video_id)
+
+
+class StreamUrlPrefetcher:
+    """
+    Resolve trước URL stream cho các bài client sắp nghe, vào stream_cache.
+    Chạy trên pool riêng, giới hạn tốc độ bằng token bucket và luôn chừa instance
+    YoutubeDL cho request tương tác, nên không bao giờ làm chậm /proxy.
+    """
+
+    def __init__(self, max_workers, max_queue, rate, burst):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stream-prefetch')
+        self._max_queue = max_queue
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._counters = {'queued': 0, 'resolved': 0, 'failed': 0, 'already_cached': 0, 'deferred': 0, 'dropped': 0}
+
+    def enqueue(self, video_ids):
+        """Xếp hàng resolve, trả về {video_id: 'cached' | 'queued' | 'pending' | 'dropped'}."""
+        statuses = {}
+        for video_id in video_ids:
+            if video_id in statuses:
+                continue
+            if video_id in stream_cache:
+                statuses[video_id] = 'cached'
+                continue
+            with self._lock:
+                if video_id in self._queued:
+                    statuses[video_id] = 'pending'
+                    continue
+                if len(self._queued) >= self._max_queue:
+                    self._counters['dropped'] += 1
+                    statuses[video_id] = 'dropped'
+                    continue
+                self._queued.add(video_id)
+                self._counters['queued'] += 1
+            self._executor.submit(self._resolve, video_id)
+            statuses[video_id] = 'queued'
+        return statuses
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, queue_depth=len(self._queued))
+
+    def _take_token(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._rate
+            time.sleep(wait_seconds)
+
+    def _resolve(self, video_id):
+        try:
+            if video_id in stream_cache:
+                self._count('already_cached')
+                return
+            self._take_token()
+
+            # Nhường YoutubeDL pool cho request tương tác
+            waited = 0
+            while ytdl_pool.available() <= STREAM_PREFETCH_RESERVED_INSTANCES:
+                if waited >= STREAM_PREFETCH_MAX_DEFER:
+                    self._count('deferred')
+                    return
+                time.sleep(0.5)
+                waited += 0.5
+
+            stream_url, _ = get_streaming_url(video_id)
+            self._count('resolved' if stream_url else 'failed')
+        except Exception as e:
+            print(f"Lỗi khi resolve trước URL stream cho {video_id}: {e}")
+            self._count('failed')
+        finally:
+            with self._lock:
+                self._queued.discard(video_id)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+stream_prefetcher = StreamUrlPrefetcher(
+    max_workers=STREAM_PREFETCH_WORKERS,
+    max_queue=STREAM_PREFETCH_QUEUE_MAX,
+    rate=STREAM_PREFETCH_RATE,
+    burst=STREAM_PREFETCH_BURST
+)
+
+@app.route('/api/resolve', methods=['POST'])
+def resolve_stream_urls():
+    """
+    Resolve trước URL stream cho nhiều bài (ví dụ cả hàng đợi sắp nghe).
+    Body: {"video_ids": ["...", ...]}. Trả về ngay trạng thái của từng video_id.
+    """
+    payload = request.get_json(silent=True) or {}
+    video_ids = payload.get('video_ids')
+    if not isinstance(video_ids, list) or not all(isinstance(video_id, str) and video_id for video_id in video_ids):
+        return _json_response({'error': "Body phải có dạng {\"video_ids\": [\"...\"]}"}), 400
+
+    video_ids = video_ids[:STREAM_PREFETCH_BATCH_MAX]
+    statuses = stream_prefetcher.enqueue(video_ids)
+    return _json_response({'results': [{'video_id': video_id, 'status': statuses[video_id]} for video_id in video_ids]}), 202
+
+def _merge_byte_ranges(ranges):
+    """Gộp các khoảng [start, end) chồng lấn hoặc liền kề."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _split_byte_range(cached_ranges, start, end):
+    """Chia [start, end) thành các đoạn (start, end, đã_cache) theo danh sách khoảng đã cache."""
+    segments = []
+    position = start
+    for cached_start, cached_end in cached_ranges:
+        if cached_end <= position:
+            continue
+        if cached_start >= end:
+            break
+        if cached_start > position:
+            segments.append((position, cached_start, False))
+            position = cached_start
+        segment_end = min(cached_end, end)
+        segments.append((position, segment_end, True))
+        position = segment_end
+        if position >= end:
+            break
+    if position < end:
+        segments.append((position, end, False))
+    return segments
+
+def _parse_content_range(content_range):
+    """'bytes 0-99/1000' -> (0, 1000). Trả (None, None) nếu không parse được hoặc không rõ tổng."""
+    try:
+        unit, _, spec = content_range.partition(' ')
+        byte_range, _, total = spec.partition('/')
+        return int(byte_range.split('-')[0]), int(total)
+    except (AttributeError, ValueError):
         return None, None
 
+
+class AudioSegmentCache:
+    """
+    Cache audio trên đĩa theo khoảng byte, key = video_id + định dạng (đuôi file và itag, xem _audio_cache_key).
+    Mỗi key có một file dữ liệu (sparse, đủ kích thước bài hát) và một file metadata JSON
+    ghi các khoảng [start, end) đã có. Cache được lấp dần khi byte chảy qua proxy,
+    khoảng nào đã có thì đọc local, khoảng nào thiếu thì lấy từ upstream và ghi lại.
+    Dung lượng được giới hạn bằng LRU theo thời gian truy cập file metadata.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._active = {} # key -> số stream đang dùng, không bị dọn
+        self._last_evict = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self._folder, f"{key}.data"), os.path.join(self._folder, f"{key}.json")
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_meta(self, key):
+        """Metadata {'size', 'content_type', 'ranges'} của key, hoặc None nếu chưa cache."""
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if not os.path.exists(data_path):
+                os.remove(meta_path)
+                return None
+            os.utime(meta_path) # đánh dấu vừa truy cập cho LRU
+            return meta
+        except FileNotFoundError:
+            return None
+        except (IOError, ValueError) as e:
+            print(f"Metadata audio cache '{key}' bị hỏng, bỏ qua: {e}")
+            return None
+
+    def create(self, key, total_size, content_type):
+        """Tạo file dữ liệu (sparse) cho key nếu chưa có và trả về metadata."""
+        data_path, meta_path = self._paths(key)
+        with self._key_lock(key):
+            meta = self.get_meta(key)
+            if meta is not None and meta['size'] == total_size:
+                return meta
+            fd = os.open(data_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, total_size)
+            finally:
+                os.close(fd)
+            meta = {'size': total_size, 'content_type': content_type, 'ranges': []}
+            _atomic_write_json(meta_path, meta)
+            return meta
+
+    def open_data_file(self, key):
+        """Mở file dữ liệu để đọc (dùng cho sendfile), None nếu vừa bị dọn."""
+        try:
+            return open(self._paths(key)[0], 'rb')
+        except FileNotFoundError:
+            return None
+
+    def mark_cached(self, key, start, end):
+        """Ghi nhận khoảng [start, end) đã được ghi xuống file dữ liệu."""
+        if end <= start:
+            return
+        _, meta_path = self._paths(key)
+        with self._key_lock(key):
+            # Đọc lại từ đĩa để không làm mất khoảng do worker khác ghi
+            meta = self.get_meta(key)
+            if meta is None:
+                return
+            meta['ranges'] = _merge_byte_ranges(meta['ranges'] + [[start, end]])
+            _atomic_write_json(meta_path, meta)
+
+    def stream(self, key, meta, stream_url, start, end, refresh_stream_url=None):
+        """
+        Generator trả các byte [start, end): đoạn đã cache đọc từ đĩa, đoạn thiếu lấy từ upstream.
+        Nếu upstream trả 403/410 (URL hết hạn), gọi refresh_stream_url() để lấy URL mới và thử lại một lần.
+        """
+        data_path, _ = self._paths(key)
+        self._acquire(key)
+        fd = os.open(data_path, os.O_RDWR)
+        retried = False
+        try:
+            for segment_start, segment_end, is_cached in _split_byte_range(meta['ranges'], start, end):
+                if is_cached:
+                    position = segment_start
+                    while position < segment_end:
+                        chunk = os.pread(fd, min(STREAM_CHUNK_MAX_SIZE, segment_end - position), position)
+                        if not chunk:
+                            return
+                        position += len(chunk)
+                        yield chunk
+                else:
+                    response = self._open_upstream_range(stream_url, segment_start, segment_end)
+                    if response.status_code in (403, 410) and refresh_stream_url and not retried:
+                        response.close()
+                        retried = True
+                        logging.warning(f"Upstream returned {response.status_code} for '{key}', re-resolving stream URL")
+                        stream_url = refresh_stream_url()
+                        if not stream_url:
+                            raise IOError(f"Could not re-resolve stream URL for '{key}'")
+                        response = self._open_upstream_range(stream_url, segment_start, segment_end)
+                    if response.status_code == 206:
+                        response_offset, total_size = _parse_content_range(response.headers.get('Content-Range'))
+                    elif response.status_code == 200:
+                        response_offset, total_size = 0, int(response.headers.get('Content-Length') or 0) or None
+                    else:
+                        response.close()
+                        raise IOError(f"Upstream returned {response.status_code}")
+                    if total_size != meta['size']:
+                        # Upstream đã là một bản mã hóa khác: không ghép byte mới vào file cũ
+                        response.close()
+                        self.drop(key)
+                        raise IOError(f"Upstream size {total_size} does not match cached size {meta['size']} for '{key}'")
+                    yield from self._relay_and_fill(key, fd, response, response_offset, segment_start, segment_end)
+        finally:
+            os.close(fd)
+            self._release(key)
+
+    def drop(self, key):
+        """Xóa hẳn một mục cache (file dữ liệu đang mở vẫn đọc được tới khi đóng)."""
+        with self._key_lock(key):
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _open_upstream_range(self, stream_url, start, end):
+        return http_get(
+            stream_url,
+            headers={
+                'User-Agent': 'Mozilla/5.0',
+                'Accept-Encoding': 'identity',
+                'Range': f"bytes={start}-{end - 1}"
+            },
+            stream=True
+        )
+
+    def relay_and_fill(self, key, response, response_offset, start, end):
+        """Relay một response upstream đã mở cho client, đồng thời ghi các byte vào cache."""
+        data_path, _ = self._paths(key)
+        self._acquire(key)
+        fd = os.open(data_path, os.O_RDWR)
+        try:
+            yield from self._relay_and_fill(key, fd, response, response_offset, start, end)
+        finally:
+            os.close(fd)
+            self._release(key)
+
+    def _relay_and_fill(self, key, fd, response, response_offset, start, end):
+        # Ghi mọi byte nhận được (kể cả ngoài [start, end)), chỉ trả cho client phần [start, end)
+        position = response_offset
+        flushed = response_offset
+        try:
+            for chunk in _iter_response_chunks(response):
+                # Ghi thẳng từ buffer dùng lại (không copy), chỉ copy phần trả cho client
+                os.pwrite(fd, chunk, position)
+                chunk_start = position
+                position += len(chunk)
+                if position - flushed >= AUDIO_CACHE_FLUSH_BYTES:
+                    self.mark_cached(key, flushed, position)
+                    flushed = position
+                if position <= start:
+                    continue
+                if chunk_start < start:
+                    chunk = chunk[start - chunk_start:]
+                    chunk_start = start
+                if chunk_start >= end:
+                    break
+                if position > end:
+                    chunk = chunk[:end - chunk_start]
+                yield chunk.tobytes()
+        finally:
+            response.close()
+            self.mark_cached(key, flushed, position)
+
+    def _acquire(self, key):
+        with self._lock:
+            self._active[key] = self._active.get(key, 0) + 1
+
+    def _release(self, key):
+        with self._lock:
+            self._active[key] -= 1
+            if not self._active[key]:
+                del self._active[key]
+            should_evict = time.monotonic() - self._last_evict >= AUDIO_CACHE_EVICT_INTERVAL
+            if should_evict:
+                self._last_evict = time.monotonic()
+        if should_evict:
+            background_executor.submit(self.evict)
+
+    def evict(self):
+        """Xóa các bài ít được truy cập nhất cho tới khi tổng dung lượng dưới giới hạn."""
+        entries = []
+        total_bytes = 0
+        for item in os.scandir(self._folder):
+            if not item.name.endswith('.json'):
+                continue
+            key = item.name[:-len('.json')]
+            data_path, meta_path = self._paths(key)
+            try:
+                # st_blocks phản ánh dung lượng thật của file sparse
+                used_bytes = os.stat(data_path).st_blocks * 512
+                last_access = item.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            total_bytes += used_bytes
+            entries.append((last_access, key, used_bytes))
+
+        entries.sort()
+        for _, key, used_bytes in entries:
+            if total_bytes <= self._max_bytes:
+                break
+            with self._lock:
+                if key in self._active:
+                    continue
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= used_bytes
+            print(f"Đã xóa audio cache '{key}' ({used_bytes} bytes).")
+
+audio_cache = AudioSegmentCache(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES)
+
 @app.route('/proxy/<string:video_id>')
 def proxy_stream(video_id):
     stream_url, ext = get_streaming_url(video_id)
     if not stream_url:
-        return jsonify({"error": "Could not get streaming URL"}), 404
+        return _json_response({"error": "Could not get streaming URL"}), 404
+
+    cache_key = _audio_cache_key(video_id, stream_url, ext)
+    meta = audio_cache.get_meta(cache_key)
+    if meta is not None:
+        return _proxy_from_cache(video_id, cache_key, meta, stream_url)
 
     range_header = request.headers.get('Range')
     headers = {
         'User-Agent': 'Mozilla/5.0',
+        'Accept-Encoding': 'identity',
     }
     if range_header:
         headers['Range'] = range_header
 
     try:
-        r = requests.get(stream_url, headers=headers, stream=True)
+        r = http_get(stream_url, headers=headers, stream=True)
+
+        # URL đã hết hạn hoặc bị thu hồi: resolve lại và thử thêm một lần
+        if r.status_code in (403, 410):
+            r.close()
+            logging.warning(f"Upstream returned {r.status_code} for {video_id}, re-resolving stream URL")
+            stream_url, ext = _reresolve_streaming_url(video_id)
+            if not stream_url:
+                return _json_response({"error": "Could not get streaming URL"}), 404
+            cache_key = _audio_cache_key(video_id, stream_url, ext)
+            r = http_get(stream_url, headers=headers, stream=True)
 
         if r.status_code not in (200, 206):
+            r.close()
             logging.error(f"Stream request failed with status {r.status_code}")
-            return jsonify({"error": f"Upstream returned {r.status_code}"}), 502
+            return _json_response({"error": f"Upstream returned {r.status_code}"}), 502
 
         content_type = r.headers.get('Content-Type', f'audio/{ext or "mp4"}')
 
@@ -566,15 +3281,113 @@ def proxy_stream(video_id):
         if r.headers.get("Content-Range"):
             response_headers["Content-Range"] = r.headers["Content-Range"]
 
+        # Biết tổng kích thước thì vừa relay vừa ghi vào audio cache
+        if r.status_code == 206:
+            response_offset, total_size = _parse_content_range(r.headers.get("Content-Range"))
+        else:
+            response_offset, total_size = 0, int(r.headers.get("Content-Length") or 0) or None
+        if total_size:
+            audio_cache.create(cache_key, total_size, content_type)
+            body = stream_stats.track(
+                audio_cache.relay_and_fill(cache_key, r, response_offset, response_offset, total_size),
+                cache_key,
+                'upstream'
+            )
+        else:
+            body = stream_stats.track(_relay_response(r), cache_key, 'upstream')
+
         return Response(
-            stream_with_context(r.iter_content(chunk_size=4096)),
+            stream_with_context(body),
             status=r.status_code,
             headers={k: v for k, v in response_headers.items() if v is not None}
         )
 
     except Exception as e:
         logging.exception("Proxy stream error:")
-        return jsonify({"error": "Failed to stream"}), 500
+        return _json_response({"error": "Failed to stream"}), 500
+
+def _proxy_from_cache(video_id, cache_key, meta, stream_url):
+    """Trả khoảng byte được yêu cầu từ audio cache (206/Content-Range đúng chuẩn), lấp phần thiếu từ upstream."""
+    total_size = meta['size']
+    if request.range:
+        byte_range = request.range.range_for_length(total_size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f"bytes */{total_size}"})
+        start, end = byte_range
+        status = 206
+    else:
+        start, end = 0, total_size
+        status = 200
+
+    response_headers = {
+        "Content-Type": meta['content_type'],
+        "Content-Length": str(end - start),
+        "Accept-Ranges": "bytes",
+    }
+    if status == 206:
+        response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{total_size}"
+
+    # Khoảng yêu cầu đã có đủ trên đĩa: để WSGI server gửi thẳng từ file (gunicorn dùng sendfile)
+    segments = _split_byte_range(meta['ranges'], start, end)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if AUDIO_CACHE_SENDFILE and file_wrapper and len(segments) == 1 and segments[0][2]:
+        data_file = audio_cache.open_data_file(cache_key)
+        if data_file is not None:
+            data_file.seek(start)
+            stream_stats.count_sendfile(end - start)
+            return Response(
+                file_wrapper(data_file, STREAM_CHUNK_MAX_SIZE),
+                status=status,
+                headers=response_headers,
+                direct_passthrough=True
+            )
+
+    def refresh_stream_url():
+        new_stream_url, new_ext = _reresolve_streaming_url(video_id)
+        # Định dạng khác thì byte trong cache không còn khớp với URL mới
+        return new_stream_url if _audio_cache_key(video_id, new_stream_url, new_ext) == cache_key else None
+
+    source = 'cache' if all(is_cached for _, _, is_cached in segments) else 'cache+upstream'
+    body = audio_cache.stream(cache_key, meta, stream_url, start, end, refresh_stream_url)
+    return Response(
+        stream_with_context(stream_stats.track(body, cache_key, source)),
+        status=status,
+        headers=response_headers
+    )
+
+def _fetch_song_details(video_id):
+    """Lấy thông tin chi tiết cho một videoId từ API và định dạng lại."""
+    # Dùng get_song để có dữ liệu video chính xác nhất
+    song_data = yt.get_song(videoId=video_id)
+    
+    # Dữ liệu trả về từ get_song có cấu trúc hơi khác, chúng ta cần xử lý nó
+    video_details = song_data.get('videoDetails', {})
+    thumbnails = video_details.get('thumbnail', {}).get('thumbnails', [])
+    thumbnail_url = thumbnails[-1]['url'] if thumbnails else ''
+    
+    # Nối tên các nghệ sĩ lại
+    artists = video_details.get('author', '').split(',')
+    artist_names = ', '.join(artist.strip() for artist in artists)
+
+    return Song.get(
+        video_id,
+        video_details.get('title', 'Unknown Title'),
+        artist_names or 'Unknown Artist',
+        # Chuyển đổi giây thành định dạng MM:SS
+        _format_duration(video_details.get('lengthSeconds')),
+        # Xếp hàng tải ảnh ở background, trả link local nếu ảnh đã có
+        resolve_thumbnail_url(thumbnail_url, video_id)
+    )
+
+# Cache metadata theo video_id, dùng chung cho /api/song/<id> và /api/songs
+song_details_cache = StaleWhileRevalidateCache(
+    maxsize=SONG_DETAILS_CACHE_MAXSIZE,
+    ttl=SONG_DETAILS_CACHE_TTL,
+    stale_ttl=SONG_DETAILS_CACHE_STALE_TTL
+)
+
+def get_cached_song_details(video_id):
+    return song_details_cache.get(video_id, lambda: _fetch_song_details(video_id))
 
 # --- ROUTE MỚI ĐỂ LẤY CHI TIẾT MỘT BÀI HÁT ---
 @app.route('/api/song/<video_id>', methods=['GET'])
@@ -583,37 +3396,54 @@ def get_song_details(video_id):
     Lấy thông tin chi tiết cho một videoId cụ thể.
     """
     if not yt:
-        return jsonify({'error': 'YTMusic service is not available.'}), 503
+        return _json_response({'error': 'YTMusic service is not available.'}), 503
         
     try:
-        # Dùng get_song để có dữ liệu video chính xác nhất
-        song_data = yt.get_song(videoId=video_id)
-        
-        # Dữ liệu trả về từ get_song có cấu trúc hơi khác, chúng ta cần xử lý nó
-        video_details = song_data.get('videoDetails', {})
-        thumbnails = video_details.get('thumbnail', {}).get('thumbnails', [])
-        thumbnail_url = thumbnails[-1]['url'] if thumbnails else ''
-        
-        # Tải ảnh về và tạo link proxy
-        local_thumbnail_path = download_and_save_image(thumbnail_url, video_id)
-        
-        # Nối tên các nghệ sĩ lại
-        artists = video_details.get('author', '').split(',')
-        artist_names = ', '.join(artist.strip() for artist in artists)
-
-        parsed_song = {
-            'video_id': video_id,
-            'title': video_details.get('title', 'Unknown Title'),
-            'artist': artist_names or 'Unknown Artist',
-            'thumbnail_url': f"{baseUrl}{local_thumbnail_path}" if local_thumbnail_path else "",
-            # Chuyển đổi giây thành định dạng MM:SS
-            'duration': _format_duration(video_details.get('lengthSeconds'))
-        }
-        
-        return Response(json.dumps(parsed_song, ensure_ascii=False), mimetype='application/json')
+        parsed_song = get_cached_song_details(video_id)
+        return _json_response(parsed_song)
 
     except Exception as e:
-        return jsonify({'error': f"Lỗi khi lấy chi tiết bài hát: {str(e)}"}), 500
+        return _json_response({'error': f"Lỗi khi lấy chi tiết bài hát: {str(e)}"}), 500
+
+@app.route('/api/songs', methods=['GET'])
+def get_songs_details():
+    """
+    Lấy thông tin chi tiết cho nhiều bài hát: /api/songs?ids=id1,id2,...
+    Bài chưa có trong cache được lấy song song; kết quả giữ đúng thứ tự ids,
+    bài nào lỗi thì trả {'video_id', 'error'} ngay tại vị trí đó.
+    """
+    if not yt:
+        return _json_response({'error': 'YTMusic service is not available.'}), 503
+
+    video_ids = [video_id.strip() for video_id in request.args.get('ids', '').split(',') if video_id.strip()]
+    if not video_ids:
+        return _json_response({'error': 'Missing ids'}), 400
+    if len(video_ids) > SONG_BATCH_MAX_IDS:
+        return _json_response({'error': f"Tối đa {SONG_BATCH_MAX_IDS} ids mỗi request"}), 400
+
+    # Lấy từ cache trước, chỉ gọi API cho những bài còn thiếu
+    songs_by_id = {}
+    futures = {}
+    for video_id in dict.fromkeys(video_ids):
+        cached_song = song_details_cache.get_if_present(video_id, lambda video_id=video_id: _fetch_song_details(video_id))
+        if cached_song is not None:
+            songs_by_id[video_id] = cached_song
+        else:
+            futures[video_id] = upstream_executor.submit(get_cached_song_details, video_id)
+
+    if futures:
+        wait(futures.values(), timeout=SONG_BATCH_TIMEOUT)
+    for video_id, future in futures.items():
+        if not future.done():
+            future.cancel()
+            songs_by_id[video_id] = {'video_id': video_id, 'error': 'timeout'}
+            continue
+        try:
+            songs_by_id[video_id] = future.result()
+        except Exception as e:
+            songs_by_id[video_id] = {'video_id': video_id, 'error': f"Lỗi khi lấy chi tiết bài hát: {str(e)}"}
+
+    return _json_response({'songs': [songs_by_id[video_id] for video_id in video_ids]})
 
 def _format_duration(seconds):
     """Hàm phụ để định dạng thời lượng từ giây sang MM:SS nếu có."""
@@ -660,43 +3490,236 @@ def get_trending_songs(limit=10):
             thumbnails = song.get("thumbnails", [])
             thumbnail_url = thumbnails[-1].get("url", "") if thumbnails else ""
 
-            songs.append({
-                "title": title,
-                "artist": artist_names,
-                "duration": duration,
-                "video_id": video_id,
-                "thumbnail_url": thumbnail_url
-            })
+            songs.append(Song.get(video_id, title, artist_names, duration, thumbnail_url))
         except Exception as song_e:
             print(f"Lỗi khi xử lý bài hát: {song_e}")
             continue
 
-    # Lưu cache nếu cần
-    global trending_songs_cache
-    trending_songs_cache = songs
-    print(f"Đã lưu {len(songs)} bài hát vào cache")
-
+    # Lưu cache dùng chung cho mọi worker
     try:
-        with open(CACHE_FILENAME_TRENDING, 'w', encoding='utf-8') as f:
-            json.dump(songs, f, indent=4, ensure_ascii=False)
-            print(f"Đã lưu cache vào file '{CACHE_FILENAME_TRENDING}'.")
-    except IOError as e:
+        shared_store.publish('trending', {"total_songs": len(songs), "songs": songs})
+        background_executor.submit(search_index.add_songs, songs)
+        print(f"Đã lưu {len(songs)} bài hát vào cache")
+    except sqlite3.Error as e:
         print(f"Lỗi khi ghi cache vào file: {e}")
 
     return songs
 
-# ROUTE MỚI ĐỂ XÓA CACHE VÀ REDIRECT
+def refresh_trending():
+    songs = get_trending_songs()
+    if not songs:
+        raise RuntimeError("Không thể lấy dữ liệu trending mới từ API.")
+    return songs
+
+def refresh_playlist_details():
+    """
+    Làm mới các playlist đã cache sắp hết hạn, cũ nhất trước,
+    tối đa REFRESH_PLAYLIST_BATCH playlist mỗi lượt.
+    """
+    interval, refresh_ahead, _ = REFRESH_SCHEDULE['playlists']
+    aged = [(age, playlist_id) for playlist_id, age in metadata_store.ages('playlist') if age >= interval - refresh_ahead]
+    playlist_ids = [playlist_id for _, playlist_id in sorted(aged, reverse=True)[:REFRESH_PLAYLIST_BATCH]]
+
+    futures = {}
+    for playlist_id in playlist_ids:
+        # Giữ nguyên số bài cache đã lấy được (có thể đã tăng do phân trang)
+        details = _cached_data(_playlist_details_key(playlist_id)) or {}
+        limit = details.get('fetched_limit') or PLAYLIST_PAGE_SIZE
+        futures[playlist_id] = upstream_executor.submit(_fetch_playlist_details, playlist_id, limit)
+    refreshed = 0
+    for playlist_id, future in futures.items():
+        try:
+            _store_json_cache(_playlist_details_key(playlist_id), future.result())
+            refreshed += 1
+        except Exception as e:
+            print(f"Không làm mới được playlist {playlist_id}: {e}")
+    if playlist_ids and not refreshed:
+        raise RuntimeError(f"Không làm mới được playlist nào trong {len(playlist_ids)} playlist.")
+    return refreshed
+
+
+class RefreshScheduler:
+    """
+    Làm mới các cache ở background theo REFRESH_SCHEDULE, để request chỉ đọc dữ liệu đã sẵn.
+    Trong các worker gunicorn chỉ worker giữ được khóa leader (fcntl, không chờ) chạy lịch;
+    worker khác thử lại mỗi tick nên leader chết thì có worker thay thế.
+    Job chạy trên background_executor, còn các lời gọi API bên trong dùng chung upstream_executor
+    với request của người dùng. Trạng thái được ghi ra REFRESH_STATUS_FILENAME để worker nào cũng đọc được.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self._leader_file = None
+        self._thread = None
+
+    def register(self, name, refresh, age):
+        """refresh() dựng lại dataset (raise nếu lỗi); age() trả tuổi dữ liệu hiện có (giây), None nếu chưa có."""
+        interval, refresh_ahead, jitter = REFRESH_SCHEDULE[name]
+        self._datasets[name] = {
+            'refresh': refresh,
+            'age': age,
+            'interval': interval,
+            'refresh_ahead': refresh_ahead,
+            'jitter': jitter,
+            'due_age': self._next_due_age(interval, refresh_ahead, jitter),
+            'retry_at': 0,
+            'running': False,
+            'future': None, # lần làm mới đang chạy
+            'status': {
+                'runs': 0, 'failures': 0, 'consecutive_failures': 0,
+                'last_started': None, 'last_refresh': None, 'last_duration': None, 'last_error': None
+            }
+        }
+
+    @staticmethod
+    def _next_due_age(interval, refresh_ahead, jitter):
+        return max(interval - refresh_ahead - random.uniform(0, jitter), 0)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='refresh-scheduler', daemon=True)
+            self._thread.start()
+
+    def is_leader(self):
+        return self._leader_file is not None
+
+    def _try_become_leader(self):
+        if self._leader_file is not None:
+            return True
+        if fcntl is None:
+            # Không có fcntl thì coi như chỉ có một worker
+            self._leader_file = True
+            return True
+        os.makedirs(CACHE_LOCK_FOLDER, exist_ok=True)
+        lock_file = open(os.path.join(CACHE_LOCK_FOLDER, 'refresh_scheduler.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Giữ file mở (và khóa) suốt vòng đời process
+        self._leader_file = lock_file
+        print(f"Worker {os.getpid()} chạy lịch làm mới cache.")
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if self._try_become_leader():
+                    self._tick()
+            except Exception as e:
+                print(f"Lỗi trong lịch làm mới cache: {e}")
+            time.sleep(REFRESH_SCHEDULER_TICK)
+
+    def _tick(self):
+        now = time.monotonic()
+        for name, dataset in self._datasets.items():
+            with self._lock:
+                running = sum(1 for d in self._datasets.values() if d['running'])
+                if running >= REFRESH_MAX_CONCURRENT:
+                    return
+                if dataset['running'] or dataset['retry_at'] > now:
+                    continue
+            age = dataset['age']()
+            if age is None or age >= dataset['due_age']:
+                self.run_now(name)
+
+    def run_now(self, name):
+        """Làm mới một dataset ngay (ở background), trả Future; nếu dataset đang được làm mới thì trả Future của lần đó."""
+        dataset = self._datasets[name]
+        with self._lock:
+            if dataset['running']:
+                return dataset['future']
+            dataset['running'] = True
+            dataset['future'] = background_executor.submit(self._refresh, name, dataset)
+            return dataset['future']
+
+    def _refresh(self, name, dataset):
+        status = dataset['status']
+        started_at = time.monotonic()
+        status['last_started'] = datetime.now(timezone.utc).isoformat()
+        try:
+            result = dataset['refresh']()
+            status['last_refresh'] = datetime.now(timezone.utc).isoformat()
+            status['last_error'] = None
+            status['consecutive_failures'] = 0
+            dataset['retry_at'] = 0
+            return result
+        except Exception as e:
+            print(f"Làm mới '{name}' thất bại, giữ dữ liệu cũ: {e}")
+            status['failures'] += 1
+            status['consecutive_failures'] += 1
+            status['last_error'] = str(e)
+            backoff = min(REFRESH_RETRY_BASE * 2 ** (status['consecutive_failures'] - 1), REFRESH_RETRY_MAX)
+            dataset['retry_at'] = time.monotonic() + backoff
+            raise
+        finally:
+            status['runs'] += 1
+            status['last_duration'] = round(time.monotonic() - started_at, 3)
+            dataset['due_age'] = self._next_due_age(dataset['interval'], dataset['refresh_ahead'], dataset['jitter'])
+            with self._lock:
+                dataset['running'] = False
+                dataset['future'] = None
+            if self.is_leader():
+                self._write_status()
+
+    def status(self):
+        with self._lock:
+            datasets = {}
+            for name, dataset in self._datasets.items():
+                age = dataset['age']()
+                datasets[name] = dict(
+                    dataset['status'],
+                    running=dataset['running'],
+                    age=round(age) if age is not None else None,
+                    interval=dataset['interval'],
+                    next_refresh_in=max(round(dataset['due_age'] - age), 0) if age is not None else 0
+                )
+        return {'leader_pid': os.getpid(), 'updated_at': datetime.now(timezone.utc).isoformat(), 'datasets': datasets}
+
+    def _write_status(self):
+        try:
+            _atomic_write_json(REFRESH_STATUS_FILENAME, self.status())
+        except IOError as e:
+            print(f"Lỗi khi ghi trạng thái làm mới cache: {e}")
+
+refresh_scheduler = RefreshScheduler()
+refresh_scheduler.register('trending', refresh_trending, lambda: shared_store.age('trending'))
+refresh_scheduler.register(
+    'popular_artists',
+    lambda: _refresh_json_cache(POPULAR_ARTISTS_KEY, lambda: _build_popular_artists(POPULAR_ARTISTS_BACKGROUND_TIMEOUT)),
+    lambda: _cache_age(POPULAR_ARTISTS_KEY)
+)
+refresh_scheduler.register(
+    'made_for_you',
+    lambda: _refresh_json_cache(MADE_FOR_YOU_KEY, _build_made_for_you),
+    lambda: _cache_age(MADE_FOR_YOU_KEY)
+)
+refresh_scheduler.register('playlists', refresh_playlist_details, lambda: metadata_store.oldest_age('playlist'))
+
+@app.route('/api/refresh_status', methods=['GET'])
+def get_refresh_status():
+    """Trạng thái các lần làm mới cache (do worker leader ghi), đọc được từ bất kỳ worker nào."""
+    if refresh_scheduler.is_leader():
+        return _json_response(refresh_scheduler.status())
+    try:
+        with open(REFRESH_STATUS_FILENAME, 'r', encoding='utf-8') as f:
+            status = json.load(f)
+    except (IOError, json.JSONDecodeError):
+        status = None
+    if status is None:
+        return _json_response({'error': 'Chưa có trạng thái làm mới cache.'}), 404
+    return _json_response(status)
+
+# Làm mới danh sách nghệ sĩ ở background rồi chuyển hướng; API vẫn trả bản cũ cho đến khi có bản mới
 @app.route('/refresh-artists-cache')
 def refresh_artists_cache():
-    """Xóa file cache và chuyển hướng người dùng trở lại trang danh sách nghệ sĩ."""
-    try:
-        if os.path.exists(CACHE_FILENAME_ARTISTS):
-            os.remove(CACHE_FILENAME_ARTISTS)
-            print("Cache nghệ sĩ đã được xóa thành công.")
-    except Exception as e:
-        print(f"Lỗi khi xóa cache: {e}")
-    
-# dùng cho server: bấm để refresh cache (trending_songs_cache)
+    """Yêu cầu làm mới cache nghệ sĩ và chuyển hướng người dùng trở lại trang danh sách nghệ sĩ."""
+    refresh_scheduler.run_now('popular_artists')
+    return redirect('/popular_artists')
+
+# dùng cho server: bấm để refresh cache trending
 @app.route('/api/fetch_trending', methods=['POST'])
 def fetch_trending_data():
     """
@@ -704,21 +3727,38 @@ def fetch_trending_data():
     và lưu vào cache.
     """
     print("Yêu cầu làm mới dữ liệu trending...")
-    # Hàm get_trending_songs của bạn đã tự động cập nhật cache rồi
-    songs = get_trending_songs() 
+    # Chạy qua refresh_scheduler để trạng thái làm mới được ghi lại; nếu đang có lần làm mới thì chờ lần đó
+    try:
+        songs = refresh_scheduler.run_now('trending').result()
+    except Exception:
+        songs = []
     
     if songs:
-        return jsonify({
+        return _json_response({
             "status": "success", 
             "message": f"Đã cập nhật thành công {len(songs)} bài hát."
         }), 200
     else:
-        return jsonify({
+        return _json_response({
             "status": "error", 
             "message": "Không thể lấy dữ liệu mới từ API."
         }), 500
 
 
+# Thống kê nội bộ của các pool / cache nền
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    return _json_response({
+        'thumbnails': thumbnail_prefetcher.stats(),
+        'image_store': image_store.stats(),
+        'image_derivatives': image_derivatives.stats(),
+        'http_pool': http_pool_stats(),
+        'streams': stream_stats.snapshot(),
+        'ytdlp_pool': ytdl_pool.stats(),
+        'stream_prefetch': stream_prefetcher.stats()
+    })
+
+
 
 
 # UIUIUIUIUIUIUIUIUI
@@ -760,7 +3800,7 @@ def show_popular_artists_page():
 # MODIFY: Route hiển thị trang Trending
 @app.route('/trending')
 def show_trending():
-    songs = trending_songs_cache 
+    songs = _trending_songs()
     
     # Giữ nguyên logic xử lý lỗi nếu cache rỗng
     if not songs:
@@ -819,7 +3859,7 @@ def show_trending():
     """
     
     # Vòng lặp for để tạo các card bài hát giữ nguyên
-    for i, song in enumerate(songs, 1):
+    for i, song in enumerate(map(_song_json, songs), 1):
         html += f"""
         <div class="song-card">
             <img src="{song['thumbnail_url']}" alt="{song['title']}" class="song-thumbnail" onerror="this.src='https://via.placeholder.com/300x180?text=No+Image'">
@@ -887,14 +3927,20 @@ def show_trending():
     </html>
     """
     return html
+def _trending_songs():
+    trending = shared_store.get('trending')
+    return trending.data['songs'] if trending is not None else []
+
+# Response khi chưa có dữ liệu trending
+EMPTY_TRENDING_ENTRY = JsonCacheEntry({"total_songs": 0, "songs": []}, time.time_ns())
+
 # New route to get raw JSON data
 @app.route('/api/trending')
 def api_trending():
-    global trending_songs_cache
-    return jsonify({
-        "total_songs": len(trending_songs_cache),
-        "songs": trending_songs_cache
-    })
+    trending = shared_store.get('trending')
+    entry = trending.entry if trending is not None else EMPTY_TRENDING_ENTRY
+    stream_prefetcher.enqueue(entry.video_ids)
+    return _json_entry_response(entry)
 # Root route
 @app.route('/')
 def home():
@@ -926,23 +3972,65 @@ def home():
     </html>
     """
 
-# Load thử xem có cache (file json) không
-# Nếu có thì load vào biến trending_songs_cache
-def load_cache():
-    """Hàm này sẽ được gọi một lần khi server bắt đầu."""
-    global trending_songs_cache
-    if os.path.exists(CACHE_FILENAME_TRENDING):
-        try:
-            with open(CACHE_FILENAME_TRENDING, 'r', encoding='utf-8') as f:
-                trending_songs_cache = json.load(f)
-                print(f"Đã tải thành công {len(trending_songs_cache)} bài hát từ file cache.")
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Lỗi khi đọc file cache: {e}. Bắt đầu với cache rỗng.")
-            trending_songs_cache = []
-    else:
-        print("Không tìm thấy file cache. Bắt đầu với cache rỗng.")
+# Khởi tạo sẵn các instance YoutubeDL ở background để lần resolve đầu tiên không phải chờ
+background_executor.submit(ytdl_pool.warm)
+
+def migrate_json_caches():
+    """
+    Chuyển các file cache JSON cũ (trending, popular artists, made for you, artist_details_cache/,
+    playlist_details_cache/) vào metadata.db rồi xóa chúng. Giữ nguyên tuổi của từng file
+    (nên hạn và lịch làm mới không đổi); file đã quá hạn bị bỏ. Chỉ một worker làm.
+    """
+    legacy_files = [(CACHE_FILENAME_ARTISTS, POPULAR_ARTISTS_KEY), (CACHE_FILENAME_MADE_FOR_YOU, MADE_FOR_YOU_KEY)]
+    for folder, kind in ((ARTIST_DETAIL_CACHE_FOLDER, 'artist'), (PLAYLIST_DETAIL_CACHE_FOLDER, 'playlist')):
+        if os.path.isdir(folder):
+            legacy_files.extend(
+                (os.path.join(folder, name), f"{kind}:{name[:-len('.json')]}")
+                for name in os.listdir(folder) if name.endswith('.json')
+            )
+    if not legacy_files and not os.path.exists(CACHE_FILENAME_TRENDING):
+        return
+
+    with _file_lock('metadata_migration'):
+        migrated = 0
+        for cache_filepath, key in legacy_files + [(CACHE_FILENAME_TRENDING, None)]:
+            try:
+                mtime_ns = os.stat(cache_filepath).st_mtime_ns
+                with open(cache_filepath, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                continue # worker khác đã chuyển
+            except (IOError, json.JSONDecodeError) as e:
+                print(f"Bỏ qua file cache hỏng '{cache_filepath}': {e}")
+                data = None
+            try:
+                remaining = METADATA_TTL - (time.time() - mtime_ns / 1e9)
+                if key is None:
+                    if data is not None and shared_store.age('trending') is None:
+                        shared_store.publish('trending', {"total_songs": len(data), "songs": data})
+                        migrated += 1
+                elif data is not None and remaining > 0 and metadata_store.version(key) is None:
+                    metadata_store.put(key, data, updated_ns=mtime_ns)
+                    migrated += 1
+                os.remove(cache_filepath)
+            except (sqlite3.Error, OSError) as e:
+                print(f"Lỗi khi chuyển '{cache_filepath}' vào metadata.db: {e}")
+        for folder in (ARTIST_DETAIL_CACHE_FOLDER, PLAYLIST_DETAIL_CACHE_FOLDER):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+        if migrated:
+            print(f"Đã chuyển {migrated} file cache JSON vào '{METADATA_DB_FILENAME}'.")
+
+migrate_json_caches()
+background_executor.submit(bootstrap_search_index)
+background_executor.submit(image_store.scan)
+suggestion_index.schedule_sync()
+
+# Lịch làm mới cache ở background (chỉ chạy ở worker giành được khóa leader)
+refresh_scheduler.start()
 
 # Run the application
 if __name__ == '__main__':
-    load_cache()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
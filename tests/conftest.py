@@ -0,0 +1,95 @@
+"""
+Fixture chung cho test: import api/index.py trong một thư mục tạm (metadata.db, cache audio, ảnh
+đều là đường dẫn tương đối) với YTMusic giả, nên test không gọi mạng và không đụng dữ liệu thật.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+import ytmusicapi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeYTMusic:
+    """
+    YTMusic giả. search_results[nhóm] là danh sách item trả về, search_errors[nhóm] là exception
+    sẽ raise, search_delay là số giây mỗi lời gọi search phải chờ. playlists[id] là số bài của playlist
+    (playlist không có trong đó thì rỗng).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.search_results = {}
+        self.search_errors = {}
+        self.search_delay = 0
+        self.playlists = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, *call):
+        with self._lock:
+            self.calls.append(call)
+
+    def search(self, query, filter=None, limit=None):
+        self._record('search', query, filter)
+        time.sleep(self.search_delay)
+        if filter in self.search_errors:
+            raise self.search_errors[filter]
+        return self.search_results.get(filter, [])[:limit]
+
+    def get_playlist(self, playlistId=None, limit=100, **kwargs):
+        self._record('get_playlist', playlistId, limit)
+        total = self.playlists.get(playlistId, 0)
+        return {
+            'id': playlistId,
+            'title': f"Playlist {playlistId}",
+            'description': '',
+            'thumbnails': [],
+            'trackCount': total,
+            'tracks': [
+                {
+                    'videoId': f"{playlistId}-{i:04d}",
+                    'title': f"Bài {i}",
+                    'artists': [{'name': 'Nghệ sĩ', 'id': 'UCx'}],
+                    'duration': '3:00',
+                    'thumbnails': []
+                }
+                for i in range(min(limit or 100, total))
+            ]
+        }
+
+
+_workdir = tempfile.mkdtemp(prefix='backend-tests-')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.chdir(_workdir)
+ytmusicapi.YTMusic = FakeYTMusic
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import index  # noqa: E402
+
+# Test tự gọi những gì cần, không để lịch làm mới chạy song song
+index.refresh_scheduler._tick = lambda: None
+
+
+@pytest.fixture
+def app_module():
+    return index
+
+
+@pytest.fixture(autouse=True)
+def yt(monkeypatch):
+    fake = FakeYTMusic()
+    monkeypatch.setattr(index, 'yt', fake)
+    monkeypatch.setattr(index.stream_prefetcher, 'enqueue', lambda *args, **kwargs: None)
+    monkeypatch.setattr(index.thumbnail_prefetcher, 'enqueue', lambda *args, **kwargs: None)
+    return fake
+
+
+@pytest.fixture
+def client():
+    return index.app.test_client()
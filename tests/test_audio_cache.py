@@ -0,0 +1,127 @@
+"""/proxy/<video_id>: cache audio theo khoảng byte (206 / 416, lấp phần thiếu từ upstream)."""
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class _AudioServer:
+    """Upstream giả hỗ trợ Range; ghi lại các header Range nhận được."""
+
+    def __init__(self, body):
+        self.body = body
+        self.ranges = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.body
+                range_header = self.headers.get('Range')
+                server.ranges.append(range_header)
+                match = re.match(r'bytes=(\d+)-(\d*)', range_header or '')
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+                    self.send_response(206)
+                    self.send_header('Content-Range', f"bytes {start}-{end}/{len(body)}")
+                    data = body[start:end + 1]
+                else:
+                    self.send_response(200)
+                    data = body
+                self.send_header('Content-Type', 'audio/mp4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._httpd.server_port}/videoplayback?itag=140"
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def upstream(app_module, monkeypatch, request):
+    server = _AudioServer(os.urandom(300 * 1024))
+    video_id = f"audio-{request.node.name}"[:40]
+    monkeypatch.setattr(app_module, 'get_streaming_url', lambda _: (server.url, 'm4a'))
+    monkeypatch.setattr(app_module, '_reresolve_streaming_url', lambda _: (server.url, 'm4a'))
+    server.video_id = video_id
+    server.cache_key = app_module._audio_cache_key(video_id, server.url, 'm4a')
+    yield server
+    server.close()
+    app_module.audio_cache.drop(server.cache_key)
+
+
+def _get(client, video_id, byte_range=None):
+    headers = {'Range': byte_range} if byte_range else {}
+    return client.get(f"/proxy/{video_id}", headers=headers)
+
+
+def test_first_range_is_relayed_and_cached(client, app_module, upstream):
+    response = _get(client, upstream.video_id, 'bytes=0-99')
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 0-99/{len(upstream.body)}"
+    assert response.data == upstream.body[:100]
+    assert app_module.audio_cache.get_meta(upstream.cache_key)['ranges'] == [[0, 100]]
+
+
+def test_cached_range_is_served_without_upstream(client, upstream):
+    _get(client, upstream.video_id, 'bytes=0-1023').close()
+    upstream.ranges.clear()
+
+    response = _get(client, upstream.video_id, 'bytes=10-509')
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 10-509/{len(upstream.body)}"
+    assert response.data == upstream.body[10:510]
+    assert upstream.ranges == []
+
+
+def test_missing_part_is_filled_from_upstream(client, app_module, upstream):
+    _get(client, upstream.video_id, 'bytes=0-99').close()
+    upstream.ranges.clear()
+
+    response = _get(client, upstream.video_id, 'bytes=50-199')
+
+    assert response.status_code == 206
+    assert response.data == upstream.body[50:200]
+    assert upstream.ranges == ['bytes=100-199']
+    assert app_module.audio_cache.get_meta(upstream.cache_key)['ranges'] == [[0, 200]]
+
+
+def test_full_request_from_cache_is_200(client, upstream):
+    _get(client, upstream.video_id).close()
+
+    response = _get(client, upstream.video_id)
+
+    assert response.status_code == 200
+    assert response.data == upstream.body
+
+
+def test_unsatisfiable_range_is_416(client, upstream):
+    _get(client, upstream.video_id, 'bytes=0-99').close()
+
+    response = _get(client, upstream.video_id, f"bytes={len(upstream.body) + 10}-")
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f"bytes */{len(upstream.body)}"
+
+
+def test_gap_fill_of_a_different_size_drops_the_entry(client, app_module, upstream):
+    _get(client, upstream.video_id, 'bytes=0-99').close()
+    # Cùng URL nhưng upstream giờ là một bản mã hóa khác
+    upstream.body = os.urandom(200 * 1024)
+
+    with pytest.raises(IOError):
+        _get(client, upstream.video_id, 'bytes=0-199').get_data()
+
+    assert app_module.audio_cache.get_meta(upstream.cache_key) is None
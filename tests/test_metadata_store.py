@@ -0,0 +1,75 @@
+"""MetadataStore: dữ liệu ghi vào metadata.db phải đọc lại y như lúc ghi."""
+
+
+def _songs_json(app_module, songs):
+    return [app_module._song_json(song) for song in songs]
+
+
+def test_artist_round_trip(app_module):
+    store = app_module.metadata_store
+    Song = app_module.Song
+    data = {
+        'artistName': 'Sơn Tùng M-TP',
+        'artistThumbnail': '/static/artists/ab/son-tung.jpg',
+        'description': 'mô tả',
+        'songs': [Song.get('rt-a1', 'Lạc Trôi', 'Sơn Tùng M-TP', '3:53', '/static/artists/cd/lac-troi.jpg')]
+    }
+    updated_ns, expires_at = store.put('artist:UCroundtrip', data)
+
+    loaded, loaded_ns, loaded_expires_at = store.get('artist:UCroundtrip')
+    assert (loaded_ns, loaded_expires_at) == (updated_ns, expires_at)
+    assert {k: v for k, v in loaded.items() if k != 'songs'} == {k: v for k, v in data.items() if k != 'songs'}
+    assert _songs_json(app_module, loaded['songs']) == _songs_json(app_module, data['songs'])
+
+
+def test_playlist_round_trip_keeps_order_and_songs_without_video_id(app_module):
+    store = app_module.metadata_store
+    Song = app_module.Song
+    songs = [Song.get(f"rt-p{i}", f"Bài {i}", 'Nghệ sĩ', '1:00', '') for i in range(5)]
+    songs.insert(2, Song.get('', 'Bài không có video_id', 'Nghệ sĩ', 'N/A', ''))
+    data = {
+        'id': 'PLroundtrip', 'title': 'Playlist', 'description': '', 'thumbnail_url': 'https://i.ytimg.com/p.jpg',
+        'total': 120, 'fetched_limit': 30, 'songs': songs
+    }
+    store.put('playlist:PLroundtrip', data)
+
+    loaded = store.get('playlist:PLroundtrip')[0]
+    assert loaded['total'] == 120
+    assert loaded['fetched_limit'] == 30
+    assert _songs_json(app_module, loaded['songs']) == _songs_json(app_module, songs)
+
+
+def test_put_replaces_previous_track_list(app_module):
+    store = app_module.metadata_store
+    Song = app_module.Song
+    store.put('playlist:PLshrink', {'id': 'PLshrink', 'songs': [Song.get(f"sh-{i}", 't', 'a', '1:00', '') for i in range(10)]})
+    store.put('playlist:PLshrink', {'id': 'PLshrink', 'songs': [Song.get('sh-new', 't', 'a', '1:00', '')]})
+
+    loaded = store.get('playlist:PLshrink')[0]
+    assert [song.video_id for song in loaded['songs']] == ['sh-new']
+
+
+def test_owners_do_not_overwrite_each_others_tracks(app_module):
+    """Cùng một video_id ở nghệ sĩ và ở playlist giữ đúng thumbnail / duration của từng bên."""
+    store = app_module.metadata_store
+    Song = app_module.Song
+    artist_song = Song.get('shared-t001', 'Bài', 'Nghệ sĩ', '3:09', '/static/artists/12/local.jpg')
+    playlist_song = Song.get('shared-t001', 'Bài', 'Nghệ sĩ, Khách mời', '1:00', 'https://i.ytimg.com/t1.jpg')
+
+    store.put('artist:UCshared', {'artistName': 'Nghệ sĩ', 'songs': [artist_song]})
+    store.put('playlist:PLshared', {'id': 'PLshared', 'songs': [playlist_song]})
+
+    assert _songs_json(app_module, store.get('artist:UCshared')[0]['songs']) == [artist_song.to_json()]
+    assert _songs_json(app_module, store.get('playlist:PLshared')[0]['songs']) == [playlist_song.to_json()]
+
+
+def test_collection_round_trip(app_module):
+    store = app_module.metadata_store
+    data = {'artists': [{'artistName': 'A', 'channelId': 'UCa', 'thumbnailUrl': ''}]}
+    store.put('collection:test_collection', data)
+    assert store.get('collection:test_collection')[0] == data
+
+
+def test_missing_key_returns_none(app_module):
+    assert app_module.metadata_store.get('artist:UCmissing') is None
+    assert app_module.metadata_store.version('playlist:PLmissing') is None
@@ -0,0 +1,60 @@
+"""Phân trang /api/playlist/<id> trên cache playlist được lấy thêm dần."""
+
+
+def _get_playlist_calls(yt):
+    return [limit for name, _, limit in yt.calls if name == 'get_playlist']
+
+
+def test_first_page(client, yt):
+    yt.playlists['PLfirst'] = 250
+
+    body = client.get('/api/playlist/PLfirst').get_json()
+
+    assert len(body['songs']) == 30
+    assert body['songs'][0]['video_id'] == 'PLfirst-0000'
+    assert (body['offset'], body['limit'], body['total'], body['next_offset']) == (0, 30, 250, 30)
+    assert _get_playlist_calls(yt) == [30]
+
+
+def test_deep_page_grows_the_cache(client, yt):
+    yt.playlists['PLdeep'] = 250
+
+    body = client.get('/api/playlist/PLdeep?offset=90&limit=50').get_json()
+
+    assert [song['video_id'] for song in body['songs']] == [f"PLdeep-{i:04d}" for i in range(90, 140)]
+    assert body['next_offset'] == 140
+    assert _get_playlist_calls(yt) == [30, 140]
+
+    # Trang đã nằm trong cache thì không gọi API nữa
+    body = client.get('/api/playlist/PLdeep?offset=30&limit=50').get_json()
+    assert body['songs'][0]['video_id'] == 'PLdeep-0030'
+    assert _get_playlist_calls(yt) == [30, 140]
+
+
+def test_last_page_has_no_next_offset(client, yt):
+    yt.playlists['PLlast'] = 250
+
+    body = client.get('/api/playlist/PLlast?offset=240&limit=50').get_json()
+
+    assert len(body['songs']) == 10
+    assert body['next_offset'] is None
+
+
+def test_offset_past_total_is_an_empty_page_without_fetching(client, yt):
+    yt.playlists['PLpast'] = 250
+
+    body = client.get('/api/playlist/PLpast?offset=4000').get_json()
+
+    assert body['songs'] == []
+    assert body['next_offset'] is None
+    assert _get_playlist_calls(yt) == [30]
+
+
+def test_invalid_paging_is_rejected(client, app_module, yt):
+    yt.playlists['PLbad'] = 10
+
+    assert client.get('/api/playlist/PLbad?offset=-1').status_code == 400
+    assert client.get(f"/api/playlist/PLbad?offset={app_module.PLAYLIST_MAX_TRACKS}").status_code == 400
+    assert client.get('/api/playlist/PLbad?limit=0').status_code == 400
+    assert client.get('/api/playlist/PLbad?limit=abc').status_code == 400
+    assert _get_playlist_calls(yt) == []
@@ -0,0 +1,67 @@
+"""/api/search: các nhóm chạy song song, nhóm lỗi được thay bằng chỉ mục cục bộ."""
+import json
+import time
+
+
+def _search_items(query):
+    return {
+        'artists': [{'resultType': 'artist', 'browseId': f"UC-{query}", 'artist': f"Nghệ sĩ {query}", 'thumbnails': []}],
+        'songs': [{
+            'resultType': 'song', 'videoId': f"v-{query}", 'title': f"Bài {query}",
+            'artists': [{'name': 'Ca sĩ'}], 'duration': '3:00', 'thumbnails': []
+        }],
+        'playlists': [{'resultType': 'playlist', 'browseId': f"PL-{query}", 'title': f"Playlist {query}", 'author': 'x', 'itemCount': 3, 'thumbnails': []}],
+    }
+
+
+def test_groups_run_concurrently_and_keep_order(client, yt):
+    yt.search_results = _search_items('songsong')
+    yt.search_delay = 0.3
+
+    started = time.monotonic()
+    body = client.get('/api/search?q=songsong').get_json()
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 0.3 * len(yt.search_results)
+    assert [item['type'] for item in body['results']] == ['artist', 'song', 'playlist']
+    assert 'source' not in body
+
+
+def test_results_are_cached_by_normalized_query(client, yt):
+    yt.search_results = _search_items('cache')
+
+    client.get('/api/search?q=Cache')
+    client.get('/api/search?q=  cache ')
+
+    assert len([call for call in yt.calls if call[0] == 'search']) == 3
+
+
+def test_failed_group_falls_back_to_local_index(client, app_module, yt):
+    app_module.search_index.add_songs([app_module.Song.get('local-fallback', 'Dự phòng cục bộ', 'Ca sĩ', '3:00', '')])
+    yt.search_results = _search_items('du phong')
+    yt.search_errors = {'songs': IOError('upstream down')}
+
+    body = client.get('/api/search?q=du phong').get_json()
+
+    songs = [item for item in body['results'] if item['type'] == 'song']
+    assert [song['video_id'] for song in songs] == ['local-fallback']
+    assert body['source'] == 'local'
+
+
+def test_all_groups_failing_without_local_results_is_an_error(client, yt):
+    yt.search_errors = {group: IOError('upstream down') for group in ('artists', 'songs', 'playlists')}
+
+    response = client.get('/api/search?q=khongcoketqua')
+
+    assert response.status_code == 500
+
+
+def test_ndjson_stream_sends_every_group_then_done(client, yt):
+    yt.search_results = _search_items('stream')
+
+    response = client.get('/api/search?q=stream&stream=ndjson')
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert sorted(event['group'] for event in events[:-1]) == ['artists', 'playlists', 'songs']
+    assert events[-1] == {'done': True}